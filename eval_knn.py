@@ -67,7 +67,7 @@ def extract_feature_pipeline(args):
     model = vits.__dict__[args.arch](patch_size=args.patch_size, num_classes=0)
     utils.replace_input_layer(model, inchannels=13)
     print(f"Model {args.arch} {args.patch_size}x{args.patch_size} built.")
-    model.cuda()
+    model.to(args.device)
     utils.load_pretrained_weights(model, args.pretrained_weights, args.checkpoint_key, args.arch, args.patch_size)
     model.eval()
 
@@ -97,8 +97,8 @@ def extract_features(model, data_loader):
     metric_logger = utils.MetricLogger(delimiter="  ")
     features = None
     for samples, index in metric_logger.log_every(data_loader, 10):
-        samples = samples.cuda(non_blocking=True)
-        index = index.cuda(non_blocking=True)
+        samples = samples.to(args.device, non_blocking=True)
+        index = index.to(args.device, non_blocking=True)
         feats = model(samples.float()).clone()
 
         # init storage feature matrix
@@ -142,7 +142,7 @@ def knn_classifier(train_features, train_labels, test_features, test_labels, k,
     train_features = train_features.t()
     num_test_images, num_chunks = test_labels.shape[0], 100
     imgs_per_chunk = num_test_images // num_chunks
-    retrieval_one_hot = torch.zeros(k, num_classes).cuda()
+    retrieval_one_hot = torch.zeros(k, num_classes, device=train_features.device)
     for idx in range(0, num_test_images, imgs_per_chunk):
         # get the features for test images
         features = test_features[
@@ -197,6 +197,8 @@ if __name__ == '__main__':
     parser.add_argument('--pretrained_weights', default='', type=str, help="Path to pretrained weights to evaluate.")
     parser.add_argument('--use_cuda', default=True, type=utils.bool_flag,
         help="Should we store the features on GPU? We recommend setting this to False if you encounter OOM")
+    parser.add_argument('--device', default='cuda', type=str, choices=['cuda', 'cpu'],
+        help="Extract the features on gpus (nccl) or on cpus (gloo, features are then stored on cpu).")
     parser.add_argument('--arch', default='deit_small', type=str,
         choices=['deit_tiny', 'deit_small', 'vit_base'], help='Architecture (support only ViT atm).')
     parser.add_argument('--patch_size', default=16, type=int, help='Patch resolution of the model.')
@@ -214,6 +216,8 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     utils.init_distributed_mode(args)
+    if args.device == "cpu":
+        args.use_cuda = False
     print("git:\n  {}\n".format(utils.get_sha()))
     print("\n".join("%s: %s" % (k, str(v)) for k, v in sorted(dict(vars(args)).items())))
     cudnn.benchmark = True
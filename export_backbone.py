@@ -0,0 +1,48 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Export the backbone of a network of a DINO training checkpoint, without the projection head,
+the other network, the optimizer state and the args of the run. The exported file is a plain
+state dict, in the format of the released DINO weights: it can be given to --pretrained_weights
+of the evaluation scripts and to the `pretrained` argument of the hubconf entry points.
+"""
+import argparse
+
+import torch
+
+import utils
+
+
+def export_backbone(checkpoint, output, checkpoint_key="teacher", dtype=None):
+    state_dict = utils.load_checkpoint_key(checkpoint, checkpoint_key, ["module."])
+    if any(k.startswith("backbone.") for k in state_dict):
+        state_dict = {k[len("backbone."):]: v for k, v in state_dict.items() if k.startswith("backbone.")}
+    if dtype is not None:
+        state_dict = {k: v.to(dtype) if v.is_floating_point() else v for k, v in state_dict.items()}
+    torch.save(state_dict, output)
+    num_params = sum(v.numel() for v in state_dict.values())
+    print(f"Exported {len(state_dict)} tensors ({num_params / 1e6:.1f}M values) of {checkpoint_key} to {output}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Export the backbone of a DINO checkpoint')
+    parser.add_argument('--checkpoint', type=str, required=True, help='path of the training checkpoint')
+    parser.add_argument('--output', type=str, required=True, help='path of the exported weights')
+    parser.add_argument('--checkpoint_key', default="teacher", type=str,
+        help='Key to use in the checkpoint (example: "teacher")')
+    parser.add_argument('--dtype', default=None, type=str, choices=['float16', 'bfloat16'],
+        help='Store the weights in this precision (default: as trained)')
+    args = parser.parse_args()
+    export_backbone(args.checkpoint, args.output, args.checkpoint_key,
+                    None if args.dtype is None else getattr(torch, args.dtype))
@@ -19,6 +19,15 @@ import vision_transformer as vits
 dependencies = ["torch", "torchvision"]
 
 
+def _state_dict(pretrained, url):
+    """
+    The reference weights, or the weights at the path `pretrained` (e.g. written by export_backbone.py).
+    """
+    if isinstance(pretrained, str):
+        return torch.load(pretrained, map_location="cpu", mmap=True)
+    return torch.hub.load_state_dict_from_url(url=url, map_location="cpu")
+
+
 def dino_deits16(pretrained=True, **kwargs):
     """
     DeiT-Small/16x16 pre-trained with DINO.
@@ -26,9 +35,9 @@ def dino_deits16(pretrained=True, **kwargs):
     """
     model = vits.__dict__["deit_small"](patch_size=16, num_classes=0, **kwargs)
     if pretrained:
-        state_dict = torch.hub.load_state_dict_from_url(
+        state_dict = _state_dict(
+            pretrained,
             url="https://dl.fbaipublicfiles.com/dino/dino_deitsmall16_pretrain/dino_deitsmall16_pretrain.pth",
-            map_location="cpu",
         )
         model.load_state_dict(state_dict, strict=True)
     return model
@@ -41,9 +50,9 @@ def dino_deits8(pretrained=True, **kwargs):
     """
     model = vits.__dict__["deit_small"](patch_size=8, num_classes=0, **kwargs)
     if pretrained:
-        state_dict = torch.hub.load_state_dict_from_url(
+        state_dict = _state_dict(
+            pretrained,
             url="https://dl.fbaipublicfiles.com/dino/dino_deitsmall8_pretrain/dino_deitsmall8_pretrain.pth",
-            map_location="cpu",
         )
         model.load_state_dict(state_dict, strict=True)
     return model
@@ -56,9 +65,9 @@ def dino_vitb16(pretrained=True, **kwargs):
     """
     model = vits.__dict__["vit_base"](patch_size=16, num_classes=0, **kwargs)
     if pretrained:
-        state_dict = torch.hub.load_state_dict_from_url(
+        state_dict = _state_dict(
+            pretrained,
             url="https://dl.fbaipublicfiles.com/dino/dino_vitbase16_pretrain/dino_vitbase16_pretrain.pth",
-            map_location="cpu",
         )
         model.load_state_dict(state_dict, strict=True)
     return model
@@ -71,9 +80,9 @@ def dino_vitb8(pretrained=True, **kwargs):
     """
     model = vits.__dict__["vit_base"](patch_size=8, num_classes=0, **kwargs)
     if pretrained:
-        state_dict = torch.hub.load_state_dict_from_url(
+        state_dict = _state_dict(
+            pretrained,
             url="https://dl.fbaipublicfiles.com/dino/dino_vitbase8_pretrain/dino_vitbase8_pretrain.pth",
-            map_location="cpu",
         )
         model.load_state_dict(state_dict, strict=True)
     return model
@@ -87,9 +96,9 @@ def dino_resnet50(pretrained=True, **kwargs):
     model = resnet50(pretrained=False, **kwargs)
     model.fc = torch.nn.Identity()
     if pretrained:
-        state_dict = torch.hub.load_state_dict_from_url(
+        state_dict = _state_dict(
+            pretrained,
             url="https://dl.fbaipublicfiles.com/dino/dino_resnet50_pretrain/dino_resnet50_pretrain.pth",
-            map_location="cpu",
         )
         model.load_state_dict(state_dict, strict=False)
     return model
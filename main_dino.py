@@ -12,11 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
+import contextlib
 import os
 import sys
 import datetime
 import time
-import math
 import json
 from pathlib import Path
 
@@ -26,8 +26,9 @@ import torch
 import torch.nn as nn
 import torch.distributed as dist
 import torch.backends.cudnn as cudnn
+from torch.distributed.optim import ZeroRedundancyOptimizer
 import torch.nn.functional as F
-from torchvision import datasets, transforms
+from torchvision import datasets
 from torchvision import models as torchvision_models
 
 import utils
@@ -52,6 +53,18 @@ def get_args_parser():
         values leads to better performance but requires more memory. Applies only
         for ViTs (deit_tiny, deit_small and vit_base). If <16, we recommend disabling
         mixed precision training (--use_fp16 false) to avoid unstabilities.""")
+    parser.add_argument('--checkpoint_blocks', default=[], type=int, nargs='*', help="""Indices of
+        the student ViT blocks whose activations are recomputed during the backward pass instead of
+        being stored (e.g. 0 1 2 3 4 5 for the first half of a 12 blocks ViT). Saves memory, so
+        that larger batches fit on a GPU, at the cost of one more forward pass of these blocks.""")
+    parser.add_argument('--drop_path_mode', default='mask', type=str, choices=['mask', 'skip'],
+        help="""How the student ViT blocks drop paths (stochastic depth): 'mask' multiplies the residual
+        branches of the dropped samples by 0, 'skip' only computes them for the kept samples, which
+        saves the compute of the dropped ones (same keep probability and expectation).""")
+    parser.add_argument('--packed_forward', type=utils.bool_flag, default=False, help="""Whether or
+        not to run the global and local crops through the student ViT in a single forward pass, with
+        their token sequences packed together and block-diagonal attention masks, instead of one
+        forward pass per resolution.""")
     parser.add_argument('--out_dim', default=65536, type=int, help="""Dimensionality of
         the DINO head output. For complex and large datasets large values (like 65k) work well.""")
     parser.add_argument('--norm_last_layer', default=True, type=utils.bool_flag,
@@ -61,8 +74,15 @@ def get_args_parser():
     parser.add_argument('--momentum_teacher', default=0.996, type=float, help="""Base EMA
         parameter for teacher update. The value is increased to 1 during training with cosine schedule.
         We recommend setting a higher value with small batches: for example use 0.9995 with batch size of 256.""")
+    parser.add_argument('--ema_every', default=1, type=int, help="""Update the teacher every x
+        iterations only, with the product of the momentums of these iterations (Default: 1).""")
     parser.add_argument('--use_bn_in_head', default=False, type=utils.bool_flag,
         help="Whether to use batch normalizations in projection head (Default: False)")
+    parser.add_argument('--shard_head', type=utils.bool_flag, default=False, help="""Whether or not
+        to split the out_dim outputs of the last layer of the DINO head, the center and the softmaxes
+        of the loss across the processes: each process computes its slice of the outputs for the
+        whole batch, which divides the memory and compute of the head and loss by the number of
+        processes. --out_dim must be divisible by the number of processes.""")
 
     # Temperature teacher parameters
     parser.add_argument('--warmup_teacher_temp', default=0.04, type=float,
@@ -73,12 +93,22 @@ def get_args_parser():
         starting with the default value of 0.04 and increase this slightly if needed.""")
     parser.add_argument('--warmup_teacher_temp_epochs', default=0, type=int,
         help='Number of warmup epochs for the teacher temperature (Default: 30).')
+    parser.add_argument('--loss_chunk_size', default=0, type=int, help="""Compute the DINO loss
+        over chunks of x output dimensions at a time (forward and backward), so that the memory used
+        by the loss does not grow with the number of crops times out_dim. 0 for computing it in one
+        pass. (Default: 0)""")
 
     # Training/Optimization parameters
     parser.add_argument('--use_fp16', type=utils.bool_flag, default=True, help="""Whether or not
         to use half precision for training. Improves training time and memory requirements,
         but can provoke instability and slight decay of performance. We recommend disabling
-        mixed precision if the loss is unstable, if reducing the patch size or if training with bigger ViTs.""")
+        mixed precision if the loss is unstable, if reducing the patch size or if training with bigger ViTs.
+        Ignored when --precision is given.""")
+    parser.add_argument('--precision', default=None, type=str, choices=['fp32', 'fp16', 'bf16'],
+        help="""Precision of the training: fp32, fp16 (autocast and loss scaling) or bf16 (autocast,
+        no loss scaling). The inputs are cast to the autocast dtype and the DINO loss is always
+        computed in fp32. Defaults to fp16 on gpu and bf16 on cpu with --use_fp16, fp32 otherwise
+        (most cpus have no fast float16 kernels).""")
     parser.add_argument('--weight_decay', type=float, default=0.04, help="""Initial value of the
         weight decay. With ViT, a smaller value at the beginning of training works well.""")
     parser.add_argument('--weight_decay_end', type=float, default=0.4, help="""Final value of the
@@ -89,6 +119,10 @@ def get_args_parser():
         help optimization for larger ViT architectures. 0 for disabling.""")
     parser.add_argument('--batch_size_per_gpu', default=64, type=int,
         help='Per-GPU batch-size : number of distinct images loaded on one GPU.')
+    parser.add_argument('--accum_steps', default=1, type=int, help="""Number of micro-batches of
+        --batch_size_per_gpu images whose gradients are accumulated before each optimizer step. The
+        effective batch size (which the learning rate is scaled with) is batch_size_per_gpu x
+        world size x accum_steps, and the schedules advance once per optimizer step. (Default: 1)""")
     parser.add_argument('--epochs', default=100, type=int, help='Number of epochs of training.')
     parser.add_argument('--freeze_last_layer', default=1, type=int, help="""Number of epochs
         during which we keep the output layer fixed. Typically doing so during
@@ -102,6 +136,31 @@ def get_args_parser():
         end of optimization. We use a cosine LR schedule with linear warmup.""")
     parser.add_argument('--optimizer', default='adamw', type=str,
         choices=['adamw', 'sgd', 'lars'], help="""Type of optimizer. We recommend using adamw with ViTs.""")
+    parser.add_argument('--shard_optimizer', type=utils.bool_flag, default=False, help="""Whether or
+        not to partition the optimizer state (e.g. the two AdamW moments) across the processes
+        (ZeroRedundancyOptimizer): each process updates its share of the student parameters and
+        broadcasts them. Checkpoints still contain the full optimizer state.""")
+    parser.add_argument('--ddp_comm_hook', default='allreduce', type=str,
+        choices=['allreduce', 'fp16', 'bf16', 'powersgd', 'hierarchical'], help="""How the student
+        gradients are averaged between the processes: full precision all-reduce (default), all-reduce
+        of the gradients cast to fp16 or bf16 (half the data), PowerSGD low-rank compression with error
+        feedback (see --powersgd_rank), or hierarchical all-reduce (within the nodes, then between the
+        nodes by each local rank on its share of the gradients). With the hooks other than allreduce,
+        the communication time of each iteration is logged as comm_time.""")
+    parser.add_argument('--log_comm_time', type=utils.bool_flag, default=False, help="""Whether or
+        not to log comm_time with --ddp_comm_hook allreduce too. The built-in reduction of DDP is
+        then replaced by the equivalent Python hook, with a callback per bucket.""")
+    parser.add_argument('--ddp_bucket_cap_mb', default=25, type=float, help="""Size (MB) of the
+        buckets of gradients reduced together while the backward pass goes on. Larger buckets make
+        fewer, more efficient transfers but start later. (Default: 25, the DDP default)""")
+    parser.add_argument('--ddp_static_graph', type=utils.bool_flag, default=False, help="""Whether or
+        not to tell DDP that the same parameters are used at every iteration, which lets it
+        optimize the order of the bucket reductions after the first iterations.""")
+    parser.add_argument('--powersgd_rank', default=4, type=int, help="""Rank of the gradient
+        approximation of --ddp_comm_hook powersgd: higher is more accurate but sends more data.""")
+    parser.add_argument('--powersgd_start_iter', default=1000, type=int, help="""Number of
+        iterations of full all-reduce before the PowerSGD compression starts (after each restart),
+        at least 2.""")
 
     # Multi-crop parameters
     parser.add_argument('--global_crops_scale', type=float, nargs='+', default=(0.4, 1.),
@@ -114,14 +173,52 @@ def get_args_parser():
     parser.add_argument('--local_crops_scale', type=float, nargs='+', default=(0.05, 0.4),
         help="""Scale range of the cropped image before resizing, relatively to the origin image.
         Used for small local view cropping of multi-crop.""")
+    parser.add_argument('--pyramid_levels', type=int, nargs='*', default=[], help="""Sizes of the
+        precomputed downsampled tiles to crop from (see sen12ms/pyramid.py), for example 128. Each crop
+        is taken from the coarsest level that still covers its output size. Empty for cropping
+        from the full resolution tiles only (Default).""")
+    parser.add_argument('--num_repeats', type=int, default=1, help="""Number of multi-crop sets
+        generated from each loaded image (repeated augmentation). Each loaded image then provides
+        num_repeats samples of the batch, which divides the data reading cost per iteration by
+        num_repeats. --batch_size_per_gpu must be divisible by this value. (Default: 1)""")
 
     # Misc
     parser.add_argument('--data_path', default='/path/to/imagenet/train/', type=str,
         help='Please specify path to the ImageNet training data.')
     parser.add_argument('--output_dir', default=".", type=str, help='Path to save logs and checkpoints.')
     parser.add_argument('--saveckp_freq', default=20, type=int, help='Save checkpoint every x epochs.')
+    parser.add_argument('--saveckp_iter_freq', default=0, type=int, help="""Also save checkpoint.pth
+        every x iterations (optimizer steps), with the position in the epoch and the random generator
+        states: a run interrupted in the middle of an epoch resumes from there and trains exactly as
+        if it had not been interrupted. 0 for only saving at the end of the epochs.""")
+    parser.add_argument('--shard_checkpoints', type=utils.bool_flag, default=False, help="""Whether or
+        not every process writes a part of the checkpoints (checkpoint.pth then lists the parts),
+        instead of the main process writing all of it.""")
     parser.add_argument('--seed', default=0, type=int, help='Random seed.')
     parser.add_argument('--num_workers', default=10, type=int, help='Number of data loading workers per GPU.')
+    parser.add_argument('--worker_threads', default=1, type=int, help="""Number of torch, OpenMP
+        and BLAS threads of each data loading worker.""")
+    parser.add_argument('--pin_cpus', type=utils.bool_flag, default=False, help="""Whether or not
+        to pin the main process and the data loading workers of each GPU to disjoint sets of cpus:
+        the cpus of the node are split between the local ranks, each worker gets --worker_threads
+        of them and the main process the remaining ones.""")
+    parser.add_argument('--worker_report_freq', default=0, type=int, help="""Print the throughput
+        (samples/s) of each data loading worker every x batches. 0 for disabling.""")
+    parser.add_argument('--prefetch', type=utils.bool_flag, default=False, help="""Whether or not to
+        collate the crops of each resolution into a single tensor and stage the next batch on the GPU,
+        in reused pinned buffers, while the current iteration runs.""")
+    parser.add_argument('--check_loss_freq', default=1, type=int, help="""Read the loss and
+        gradient norm back from the GPU, log them and check that the loss is finite every x
+        iterations only. In between, the values are kept on the GPU so that the host does not wait for
+        the device at every iteration. A non finite loss stops the training at most x iterations
+        after it happened, and its iteration is written to log.txt. (Default: 1)""")
+    parser.add_argument('--device', default='cuda', type=str, choices=['cuda', 'cpu'], help="""Train
+        on gpus (one process per gpu, nccl) or on cpus (gloo, see run_local.py for spawning several
+        processes on one machine).""")
+    parser.add_argument('--compile', type=utils.bool_flag, default=False, help="""Whether or not to
+        compile the student, the teacher (backbone and DINO head) and the DINO loss with torch.compile.
+        One graph is compiled for each crop resolution before training (batches of other shapes run
+        eagerly) and the compiled kernels are cached in output_dir/compile_cache for restarts.""")
     parser.add_argument("--dist_url", default="env://", type=str, help="""url used to set up
         distributed training; see https://pytorch.org/docs/stable/distributed.html""")
     parser.add_argument("--local_rank", default=0, type=int, help="Please ignore and do not set this argument.")
@@ -130,31 +227,68 @@ def get_args_parser():
 
 def train_dino(args):
     utils.init_distributed_mode(args)
+    if args.precision is None:
+        args.precision = ("fp16" if args.device == "cuda" else "bf16") if args.use_fp16 else "fp32"
+    precision = utils.PrecisionPolicy(args.precision, args.device)
+    assert not (args.shard_head and args.shard_optimizer), \
+        "--shard_head cannot be combined with --shard_optimizer"
     utils.fix_random_seeds(args.seed)
     print("git:\n  {}\n".format(utils.get_sha()))
     print("\n".join("%s: %s" % (k, str(v)) for k, v in sorted(dict(vars(args)).items())))
     cudnn.benchmark = True
 
     # ============ preparing data ... ============
-    transform = DataAugmentationDINO(
+    augmentation = DataAugmentationDINO(
         args.global_crops_scale,
         args.local_crops_scale,
         args.local_crops_number,
+        seed=args.seed,
     )
+    transform = augmentation
+    if args.num_repeats > 1:
+        transform = utils.RepeatedAugmentation(augmentation, args.num_repeats)
     #dataset = datasets.ImageFolder(args.data_path, transform=transform)
     from sen12ms import get_transform
     dataset = AllSen12MSDataset(args.data_path, "train", transform=transform, tansform_coord=None,
-                 classes=None, seasons=None, split_by_region=True, download=False)
+                 classes=None, seasons=None, split_by_region=True, download=False,
+                 pyramid_levels=args.pyramid_levels, transform_with_index=True)
 
     sampler = torch.utils.data.DistributedSampler(dataset, shuffle=True)
+    collate_fn = None
+    if args.num_repeats > 1:
+        assert args.batch_size_per_gpu % args.num_repeats == 0, \
+            "--batch_size_per_gpu must be divisible by --num_repeats"
+        sampler = utils.RepeatedAugSampler(dataset, args.num_repeats, shuffle=True)
+        collate_fn = utils.repeated_augmentation_collate
+    # epochs can start after their first samples (resuming from an iteration checkpoint)
+    sampler = utils.ResumableSampler(sampler)
+    if args.prefetch:
+        collate_fn = utils.multicrop_collate
+    if args.worker_report_freq:
+        collate_fn = utils.ThroughputCollate(collate_fn, args.worker_report_freq)
+    worker_init_fn = utils.WorkerInit(args.worker_threads)
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", max(torch.cuda.device_count(), 1)))
+    if args.pin_cpus:
+        main_cpus, worker_init_fn.worker_cpus = utils.get_cpu_sets(
+            args.gpu, local_world_size, args.num_workers, args.worker_threads)
+        os.sched_setaffinity(0, main_cpus)
+        torch.set_num_threads(len(main_cpus))
+        print(f"Main process pinned to cpus {main_cpus}, workers to {worker_init_fn.worker_cpus}")
     data_loader = torch.utils.data.DataLoader(
         dataset,
         sampler=sampler,
-        batch_size=args.batch_size_per_gpu,
+        batch_size=args.batch_size_per_gpu // args.num_repeats,
         num_workers=args.num_workers,
-        pin_memory=True,
+        pin_memory=args.device == "cuda" and not args.prefetch,  # the prefetcher copies into its own pinned buffers
         drop_last=True,
+        collate_fn=collate_fn,
+        worker_init_fn=worker_init_fn,
+        # the data loader does not draw from the global generator, whose state is checkpointed
+        generator=torch.Generator().manual_seed(args.seed),
     )
+    if args.prefetch:
+        data_loader = utils.MultiCropPrefetcher(data_loader, args.device,
+            dtype=precision.input_dtype)
     print(f"Data loaded: there are {len(dataset)} images.")
 
     # ============ building student and teacher networks ... ============
@@ -163,6 +297,8 @@ def train_dino(args):
         student = vits.__dict__[args.arch](
             patch_size=args.patch_size,
             drop_path_rate=0.1,  # stochastic depth
+            checkpoint_blocks=args.checkpoint_blocks,
+            drop_path_mode=args.drop_path_mode,
         )
         teacher = vits.__dict__[args.arch](patch_size=args.patch_size)
         embed_dim = student.embed_dim
@@ -184,30 +320,67 @@ def train_dino(args):
         args.out_dim,
         use_bn=args.use_bn_in_head,
         norm_last_layer=args.norm_last_layer,
-    ))
+        shard_out_dim=args.shard_head,
+    ), packed=args.packed_forward)
     teacher = utils.MultiCropWrapper(
         teacher,
-        DINOHead(embed_dim, args.out_dim, args.use_bn_in_head),
+        DINOHead(embed_dim, args.out_dim, args.use_bn_in_head, shard_out_dim=args.shard_head),
     )
     # move networks to gpu
-    student, teacher = student.cuda(), teacher.cuda()
+    student, teacher = student.to(args.device), teacher.to(args.device)
+    if args.compile:
+        # the compiled kernels are cached on disk and reused when the training restarts
+        # (set here since importing torch already defaults it to a temporary directory)
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.join(args.output_dir, "compile_cache")
+        crops = [torch.randn(args.batch_size_per_gpu, 13, size, size, device=args.device,
+                             dtype=precision.input_dtype)
+                 for size in [augmentation.global_crops_size] * 2 +
+                 [augmentation.local_crops_size] * args.local_crops_number]
+        start = time.time()
+        with precision.autocast():
+            student.compile_resolutions(crops, backward=True)
+        print(f"Student compiled for crops of {sorted({c.shape[-1] for c in crops})} px "
+              f"in {time.time() - start:.1f}s")
+    device_ids = [args.gpu] if args.device == "cuda" else None
+    if args.shard_head:
+        # each process keeps and updates its own slice of the head, DDP leaves it alone
+        sharded_params = [n for n, p in student.named_parameters() if getattr(p, "sharded", False)]
+        for model in (student, teacher):
+            nn.parallel.DistributedDataParallel._set_params_and_buffers_to_ignore_for_model(model, sharded_params)
     # synchronize batch norms (if any)
     if utils.has_batchnorms(student):
         student = nn.SyncBatchNorm.convert_sync_batchnorm(student)
         teacher = nn.SyncBatchNorm.convert_sync_batchnorm(teacher)
 
         # we need DDP wrapper to have synchro batch norms working...
-        teacher = nn.parallel.DistributedDataParallel(teacher, device_ids=[args.gpu])
+        teacher = nn.parallel.DistributedDataParallel(teacher, device_ids=device_ids)
         teacher_without_ddp = teacher.module
     else:
         # teacher_without_ddp and teacher are the same thing
         teacher_without_ddp = teacher
-    student = nn.parallel.DistributedDataParallel(student, device_ids=[args.gpu])
+    student = nn.parallel.DistributedDataParallel(student, device_ids=device_ids,
+        bucket_cap_mb=args.ddp_bucket_cap_mb, static_graph=args.ddp_static_graph)
+    # the gradient communication is timed (comm_time in the logs), the default all-reduce stays the
+    # built-in one of DDP unless asked for
+    comm_timer = None
+    if args.ddp_comm_hook != "allreduce" or args.log_comm_time:
+        comm_state, comm_hook = utils.get_comm_hook(args.ddp_comm_hook, local_world_size,
+                                                    args.powersgd_rank, args.powersgd_start_iter)
+        comm_timer = utils.CommTimer(comm_hook)
+        student.register_comm_hook(comm_state, comm_timer)
     # teacher and student start with the same weights
     teacher_without_ddp.load_state_dict(student.module.state_dict())
     # there is no backpropagation through the teacher, so no need for gradients
     for p in teacher.parameters():
         p.requires_grad = False
+    if args.compile:
+        start = time.time()
+        with precision.autocast():
+            teacher_without_ddp.compile_resolutions(crops[:2])
+        print(f"Teacher compiled in {time.time() - start:.1f}s")
+    # fused EMA update of the teacher with the student weights
+    teacher_ema = utils.TeacherEMA(student.module.parameters(), teacher_without_ddp.parameters(),
+                                   every=args.ema_every)
     print(f"Student and Teacher are built: they are both {args.arch} network.")
 
     # ============ preparing loss ... ============
@@ -218,40 +391,53 @@ def train_dino(args):
         args.teacher_temp,
         args.warmup_teacher_temp_epochs,
         args.epochs,
-    ).cuda()
+        chunk_size=args.loss_chunk_size,
+        sharded=args.shard_head,
+    ).to(args.device)
+    if args.compile:
+        dino_loss.cross_entropy = torch.compile(dino_loss.cross_entropy, dynamic=False)
 
     # ============ preparing optimizer ... ============
     params_groups = utils.get_params_groups(student)
     if args.optimizer == "adamw":
-        optimizer = torch.optim.AdamW(params_groups)  # to use with ViTs
+        optimizer_class, optimizer_kwargs = torch.optim.AdamW, {}  # to use with ViTs
     elif args.optimizer == "sgd":
-        optimizer = torch.optim.SGD(params_groups, lr=0, momentum=0.9)  # lr is set by scheduler
+        optimizer_class, optimizer_kwargs = torch.optim.SGD, {"lr": 0, "momentum": 0.9}  # lr is set by scheduler
     elif args.optimizer == "lars":
-        optimizer = utils.LARS(params_groups)  # to use with convnet and large batches
+        optimizer_class, optimizer_kwargs = utils.LARS, {}  # to use with convnet and large batches
+    if args.shard_optimizer:
+        # each process only keeps (and updates) the optimizer state of its share of the parameters
+        optimizer = ZeroRedundancyOptimizer(params_groups, optimizer_class=optimizer_class, **optimizer_kwargs)
+    else:
+        optimizer = optimizer_class(params_groups, **optimizer_kwargs)
+    if args.shard_head:
+        utils.shard_optimizer_state(optimizer, [p for p in student.parameters() if getattr(p, "sharded", False)])
     # for mixed precision training
-    fp16_scaler = None
-    if args.use_fp16:
-        fp16_scaler = torch.cuda.amp.GradScaler()
+    fp16_scaler = precision.grad_scaler()
 
     # ============ init schedulers ... ============
+    # the schedules advance once per optimizer step, i.e. every args.accum_steps batches
+    niter_per_ep = len(data_loader) // args.accum_steps
+    # dataset samples drawn per optimizer step by all the processes
+    samples_per_step = args.accum_steps * (args.batch_size_per_gpu // args.num_repeats) * utils.get_world_size()
     lr_schedule = utils.cosine_scheduler(
-        args.lr * (args.batch_size_per_gpu * utils.get_world_size()) / 256.,  # linear scaling rule
+        args.lr * (args.batch_size_per_gpu * utils.get_world_size() * args.accum_steps) / 256.,  # linear scaling rule
         args.min_lr,
-        args.epochs, len(data_loader),
+        args.epochs, niter_per_ep,
         warmup_epochs=args.warmup_epochs,
     )
     wd_schedule = utils.cosine_scheduler(
         args.weight_decay,
         args.weight_decay_end,
-        args.epochs, len(data_loader),
+        args.epochs, niter_per_ep,
     )
     # momentum parameter is increased to 1. during training with a cosine schedule
     momentum_schedule = utils.cosine_scheduler(args.momentum_teacher, 1,
-                                               args.epochs, len(data_loader))
+                                               args.epochs, niter_per_ep)
     print(f"Loss, optimizer and schedulers ready.")
 
     # ============ optionally resume training ... ============
-    to_restore = {"epoch": 0}
+    to_restore = {"epoch": 0, "epoch_samples": 0, "rng_states": None, "precision": args.precision}
     utils.restart_from_checkpoint(
         os.path.join(args.output_dir, "checkpoint.pth"),
         run_variables=to_restore,
@@ -260,116 +446,207 @@ def train_dino(args):
         optimizer=optimizer,
         fp16_scaler=fp16_scaler,
         dino_loss=dino_loss,
+        teacher_ema=teacher_ema,
     )
+    # the position in the epoch is counted in samples of all the processes: the training can resume
+    # with a different number of processes (elastic training), the schedules, the learning rate
+    # (linear scaling rule) and the sampler shards were computed above for the current one. Then
+    # the samples of the interrupted step (less than one batch of all the processes) are used twice.
     start_epoch = to_restore["epoch"]
+    resume_step = to_restore["epoch_samples"] // samples_per_step
+    if to_restore["rng_states"] is not None:
+        if len(to_restore["rng_states"]) == utils.get_world_size():
+            utils.set_rng_state(to_restore["rng_states"][utils.get_rank()])
+        else:
+            print(f"Resuming a training of {len(to_restore['rng_states'])} processes with "
+                  f"{utils.get_world_size()} processes.")
+            # new random streams rather than the ones of the beginning of the training
+            utils.fix_random_seeds(args.seed + start_epoch * niter_per_ep + resume_step)
+    if to_restore["precision"] != args.precision:
+        print(f"Resuming a {to_restore['precision']} training in {args.precision}: the loss scaler state "
+              f"is only kept between fp16 trainings.")
+
+    # checkpoints are written in the background while the training goes on
+    checkpoint_writer = utils.CheckpointWriter(args.output_dir, sharded=args.shard_checkpoints)
+
+    def save_checkpoint(iteration, copies=()):
+        """
+        Save the training state after `iteration` optimizer steps.
+        """
+        dino_loss.sync_center()
+        save_dict = {
+            'student': student.state_dict(),
+            'teacher': teacher.state_dict(),
+            'optimizer': utils.optimizer_state_dict(optimizer),
+            'epoch': iteration // niter_per_ep,
+            'epoch_samples': iteration % niter_per_ep * samples_per_step,
+            'iteration': iteration,
+            'rng_states': utils.get_rng_states(),
+            'args': args,
+            'precision': args.precision,
+            'dino_loss': dino_loss.state_dict(),
+            'teacher_ema': teacher_ema.state_dict(),
+        }
+        if fp16_scaler is not None:
+            save_dict['fp16_scaler'] = fp16_scaler.state_dict()
+        checkpoint_writer.save(save_dict, 'checkpoint.pth', copies)
 
     start_time = time.time()
     print("Starting DINO training !")
     for epoch in range(start_epoch, args.epochs):
-        data_loader.sampler.set_epoch(epoch)
+        # optimizer steps of this epoch done before resuming, their samples are skipped
+        start_step = resume_step if epoch == start_epoch else 0
+        data_loader.sampler.set_epoch(epoch, start_step * samples_per_step)
+        augmentation.set_epoch(epoch)
 
         # ============ training one epoch of DINO ... ============
-        train_stats = train_one_epoch(student, teacher, teacher_without_ddp, dino_loss,
+        train_stats = train_one_epoch(student, teacher, teacher_ema, dino_loss,
             data_loader, optimizer, lr_schedule, wd_schedule, momentum_schedule,
-            epoch, fp16_scaler, args)
+            epoch, fp16_scaler, precision, args, start_step, save_checkpoint, comm_timer)
 
         # ============ writing logs ... ============
-        save_dict = {
-            'student': student.state_dict(),
-            'teacher': teacher.state_dict(),
-            'optimizer': optimizer.state_dict(),
-            'epoch': epoch + 1,
-            'args': args,
-            'dino_loss': dino_loss.state_dict(),
-        }
-        if fp16_scaler is not None:
-            save_dict['fp16_scaler'] = fp16_scaler.state_dict()
-        utils.save_on_master(save_dict, os.path.join(args.output_dir, 'checkpoint.pth'))
+        copies = []
         if args.saveckp_freq and epoch % args.saveckp_freq == 0:
-            utils.save_on_master(save_dict, os.path.join(args.output_dir, f'checkpoint{epoch:04}.pth'))
+            copies.append(f'checkpoint{epoch:04}.pth')
+        save_checkpoint((epoch + 1) * niter_per_ep, copies)
         log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
-                     'epoch': epoch}
+                     'epoch': epoch, **checkpoint_writer.stats}
         if utils.is_main_process():
             with (Path(args.output_dir) / "log.txt").open("a") as f:
                 f.write(json.dumps(log_stats) + "\n")
+    checkpoint_writer.close()
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print('Training time {}'.format(total_time_str))
 
 
-def train_one_epoch(student, teacher, teacher_without_ddp, dino_loss, data_loader,
+def train_one_epoch(student, teacher, teacher_ema, dino_loss, data_loader,
                     optimizer, lr_schedule, wd_schedule, momentum_schedule,epoch,
-                    fp16_scaler, args):
+                    fp16_scaler, precision, args, start_step=0, save_checkpoint=None, comm_timer=None):
+    """
+    `start_step` optimizer steps of the epoch are already done (the data loader skips their batches),
+    `save_checkpoint(iteration)` is called every args.saveckp_iter_freq steps, the time of the
+    gradient communication is read from `comm_timer`.
+    """
     metric_logger = utils.MetricLogger(delimiter="  ")
     header = 'Epoch: [{}/{}]'.format(epoch, args.epochs)
-    for it, (images, _) in enumerate(metric_logger.log_every(data_loader, 10, header)):
-        # update weight decay and learning rate according to their schedule
-        it = len(data_loader) * epoch + it  # global training iteration
-        for i, param_group in enumerate(optimizer.param_groups):
-            param_group["lr"] = lr_schedule[it]
-            if i == 0:  # only the first group is regularized
-                param_group["weight_decay"] = wd_schedule[it]
-
-
-        # teacher and student forward passes + compute dino loss
-        with torch.cuda.amp.autocast(fp16_scaler is not None):
-            # move images to gpu
-            images = [im.cuda(non_blocking=True).half() for im in images]
-
-            teacher_output = teacher(images[:2])  # only the 2 global views pass through the teacher
-            student_output = student(images)
-            loss = dino_loss(student_output, teacher_output, epoch)
-
-        if not math.isfinite(loss.item()):
-            print("Loss is {}, stopping training".format(loss.item()), force=True)
-            sys.exit(1)
+    student_params = list(student.parameters())
+    last_layer_params = utils.get_last_layer_params(student)
+    loss_monitor = utils.DeferredMetrics(metric_logger, args.check_loss_freq)
+    niter_per_ep = len(lr_schedule) // args.epochs
+    # the data loader is shortened by the skipped steps
+    num_steps = min(start_step + len(data_loader) // args.accum_steps, niter_per_ep)
+    for micro_it, (images, _) in enumerate(metric_logger.log_every(data_loader, 10, header),
+                                           start_step * args.accum_steps):
+        if micro_it == num_steps * args.accum_steps:
+            break  # the last micro-batches do not make a full optimizer step
+        it, micro_step = divmod(micro_it, args.accum_steps)
+        it = niter_per_ep * epoch + it  # global training iteration
+        last_micro_step = micro_step == args.accum_steps - 1
+        if micro_step == 0:
+            # update weight decay and learning rate according to their schedule
+            for i, param_group in enumerate(optimizer.param_groups):
+                param_group["lr"] = lr_schedule[it]
+                if i == 0:  # only the first group is regularized
+                    param_group["weight_decay"] = wd_schedule[it]
+            optimizer.zero_grad()
+            step_loss = 0
+
+        # gradients are only all-reduced on the last micro-batch of the step
+        with contextlib.nullcontext() if last_micro_step else student.no_sync():
+            # teacher and student forward passes + compute dino loss
+            with precision.autocast():
+                # move images to gpu
+                images = [precision.cast_input(im.to(args.device, non_blocking=True)) for im in images]
+
+                teacher_output = teacher(images[:2])  # only the 2 global views pass through the teacher
+                student_output = student(images)
+                # the center is updated with the teacher outputs of all the micro-batches of the step
+                loss = dino_loss(student_output, teacher_output, epoch,
+                                 reduce_center=last_micro_step) / args.accum_steps
+            step_loss = step_loss + loss.detach()
+
+            if fp16_scaler is None:
+                loss.backward()
+            else:
+                fp16_scaler.scale(loss).backward()
+        if not last_micro_step:
+            continue
 
         # student update
-        optimizer.zero_grad()
         param_norms = None
         if fp16_scaler is None:
-            loss.backward()
             if args.clip_grad:
-                param_norms = utils.clip_gradients(student, args.clip_grad)
-            utils.cancel_gradients_last_layer(epoch, student,
+                param_norms = utils.clip_gradients(student_params, args.clip_grad)
+            utils.cancel_gradients_last_layer(epoch, last_layer_params,
                                               args.freeze_last_layer)
             optimizer.step()
         else:
-            fp16_scaler.scale(loss).backward()
             if args.clip_grad:
                 fp16_scaler.unscale_(optimizer)  # unscale the gradients of optimizer's assigned params in-place
-                param_norms = utils.clip_gradients(student, args.clip_grad)
-            utils.cancel_gradients_last_layer(epoch, student,
+                param_norms = utils.clip_gradients(student_params, args.clip_grad)
+            utils.cancel_gradients_last_layer(epoch, last_layer_params,
                                               args.freeze_last_layer)
             fp16_scaler.step(optimizer)
             fp16_scaler.update()
 
         # EMA update for the teacher
-        with torch.no_grad():
-            m = momentum_schedule[it]  # momentum parameter
-            for param_q, param_k in zip(student.module.parameters(), teacher_without_ddp.parameters()):
-                param_k.data.mul_(m).add_((1 - m) * param_q.detach().data)
-
-        # logging
-        torch.cuda.synchronize()
-        metric_logger.update(loss=loss.item())
+        teacher_ema.update(momentum_schedule[it])
+
+        # logging, the loss is only read back from the gpu every args.check_loss_freq iterations
+        norms = {} if param_norms is None else {"grad_norm": param_norms.norm()}
+        nonfinite = loss_monitor.update(it, loss=step_loss, **norms)
+        if nonfinite is not None:
+            stop_on_nonfinite(*nonfinite, args)
         metric_logger.update(lr=optimizer.param_groups[0]["lr"])
         metric_logger.update(wd=optimizer.param_groups[0]["weight_decay"])
+        if comm_timer is not None:
+            metric_logger.update(comm_time=comm_timer.pop())
+        last_step = micro_it + 1 == num_steps * args.accum_steps  # saved at the end of the epoch
+        if args.saveckp_iter_freq and (it + 1) % args.saveckp_iter_freq == 0 and not last_step:
+            # never checkpoint weights that a pending non-finite loss has already corrupted
+            nonfinite = loss_monitor.flush()
+            if nonfinite is not None:
+                stop_on_nonfinite(*nonfinite, args)
+            save_checkpoint(it + 1)
+    nonfinite = loss_monitor.flush()
+    if nonfinite is not None:
+        stop_on_nonfinite(*nonfinite, args)
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
     return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
 
 
+def stop_on_nonfinite(it, name, value, args):
+    print("{} is {} at iteration {}, stopping training".format(name, value, it), force=True)
+    if utils.is_main_process():
+        with (Path(args.output_dir) / "log.txt").open("a") as f:
+            f.write(json.dumps({"nonfinite": name, "value": str(value), "iteration": it}) + "\n")
+    sys.exit(1)
+
+
 class DINOLoss(nn.Module):
     def __init__(self, out_dim, ncrops, warmup_teacher_temp, teacher_temp,
                  warmup_teacher_temp_epochs, nepochs, student_temp=0.1,
-                 center_momentum=0.9):
+                 center_momentum=0.9, chunk_size=0, sharded=False):
         super().__init__()
         self.student_temp = student_temp
         self.center_momentum = center_momentum
         self.ncrops = ncrops
+        self.chunk_size = chunk_size
+        # outputs of a sharded DINOHead: each process holds a slice of the out_dim outputs
+        # (and of the center) for the whole batch
+        self.sharded = sharded
+        if sharded:
+            start, end = utils.shard_range(out_dim)
+            out_dim = end - start
+            utils.shard_state_dict(self, ["center"], dim=1)
         self.register_buffer("center", torch.zeros(1, out_dim))
+        # batch center being reduced across processes, applied before the next centering
+        self.pending_center = None
+        # sum and count of the teacher outputs of the previous micro-batches of the step
+        self.accumulated_center = None
         # we apply a warm up for the teacher temperature because
         # a too high temperature makes the training instable at the beginning
         self.teacher_temp_schedule = np.concatenate((
@@ -378,70 +655,176 @@ class DINOLoss(nn.Module):
             np.ones(nepochs - warmup_teacher_temp_epochs) * teacher_temp
         ))
 
-    def forward(self, student_output, teacher_output, epoch):
+    def pair_weights(self, device):
+        """
+        [ncrops, 2] weight of each teacher view in the target of each student view: every pair
+        counts once, except the ones where student and teacher operate on the same view.
+        """
+        weights = torch.ones(self.ncrops, 2, device=device)
+        weights[0, 0] = weights[1, 1] = 0
+        return weights
+
+    def forward(self, student_output, teacher_output, epoch, reduce_center=True):
         """
         Cross-entropy between softmax outputs of the teacher and student networks.
+        With reduce_center=False, the teacher output is only accumulated for the next center update.
         """
-        student_out = student_output / self.student_temp
-        student_out = student_out.chunk(self.ncrops)
-
-        # teacher centering and sharpening
-        temp = self.teacher_temp_schedule[epoch]
-        teacher_out = F.softmax((teacher_output - self.center) / temp, dim=-1)
-        teacher_out = teacher_out.detach().chunk(2)
-
-        total_loss = 0
-        n_loss_terms = 0
-        for iq, q in enumerate(teacher_out):
-            for v in range(len(student_out)):
-                if v == iq:
-                    # we skip cases where student and teacher operate on the same view
-                    continue
-                loss = torch.sum(-q * F.log_softmax(student_out[v], dim=-1), dim=-1)
-                total_loss += loss.mean()
-                n_loss_terms += 1
-        total_loss /= n_loss_terms
-        self.update_center(teacher_output)
+        # the softmaxes and the center are computed in fp32 whatever the precision of the outputs
+        with torch.autocast(student_output.device.type, enabled=False):
+            teacher_output = teacher_output.float()
+            # teacher centering and sharpening
+            self.sync_center()
+            temp = self.teacher_temp_schedule[epoch]
+            teacher_logits = (teacher_output - self.center) / temp
+            if self.sharded:
+                teacher_out = torch.exp(teacher_logits - utils.distributed_logsumexp(teacher_logits)[:, None])
+            else:
+                teacher_out = F.softmax(teacher_logits, dim=-1)
+            teacher_out = teacher_out.detach()
+            # the reduction of the batch center overlaps with the rest of the step
+            self.update_center(teacher_output, reduce=reduce_center)
+
+            weights = self.pair_weights(student_output.device)
+            if self.chunk_size or self.sharded:
+                total_loss = ChunkedCrossEntropy.apply(student_output, teacher_out, weights, self.student_temp,
+                                                       self.chunk_size or student_output.shape[-1], self.sharded)
+            else:
+                total_loss = self.cross_entropy(student_output, teacher_out, weights)
         return total_loss
 
+    def cross_entropy(self, student_output, teacher_out, weights):
+        # one log-softmax per student view, then the cross-entropy of every
+        # (student view, teacher view) pair as a dot product: [ncrops, 2, B]
+        student_out = F.log_softmax(student_output.float() / self.student_temp, dim=-1)
+        student_out = student_out.view(self.ncrops, -1, student_out.shape[-1])
+        teacher_out = teacher_out.view(2, -1, teacher_out.shape[-1])
+        loss = -torch.einsum("vbd,wbd->vwb", student_out, teacher_out)
+        return (loss.mean(dim=-1) * weights).sum() / weights.sum()
+
     @torch.no_grad()
-    def update_center(self, teacher_output):
+    def update_center(self, teacher_output, reduce=True):
         """
-        Update center used for teacher output.
+        Start the reduction of the batch center across processes, without waiting for it:
+        the ema update of the center is applied by the next call to sync_center.
+        With reduce=False, the teacher output is added to the batch center of the next reduction
+        (gradient accumulation: the center is updated once for all the micro-batches of a step).
         """
         batch_center = torch.sum(teacher_output, dim=0, keepdim=True)
-        dist.all_reduce(batch_center)
-        batch_center = batch_center / (len(teacher_output) * dist.get_world_size())
+        count = len(teacher_output)
+        if self.accumulated_center is not None:
+            batch_center = batch_center + self.accumulated_center[0]
+            count += self.accumulated_center[1]
+            self.accumulated_center = None
+        if not reduce:
+            self.accumulated_center = (batch_center, count)
+            return
+        work, world_size = None, 1
+        # a sharded teacher output already holds the outputs of all the processes
+        if utils.is_dist_avail_and_initialized() and not self.sharded:
+            work = dist.all_reduce(batch_center, async_op=True)
+            world_size = utils.get_world_size()
+        self.pending_center = (batch_center, work, count * world_size)
+
+    @torch.no_grad()
+    def sync_center(self):
+        """
+        Wait for the pending batch center (if any) and update the center used for teacher output.
+        """
+        if self.pending_center is None:
+            return
+        batch_center, work, count = self.pending_center
+        self.pending_center = None
+        if work is not None:
+            work.wait()
+        batch_center = batch_center / count
 
         # ema update
         self.center = self.center * self.center_momentum + batch_center * (1 - self.center_momentum)
 
 
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """
+    DINO cross-entropy computed over chunks of `chunk_size` output dimensions at a time, in
+    the forward and in the backward pass, so that no [ncrops * B, out_dim] log-softmax is kept:
+    only the logsumexp of each student output is saved for the backward pass.
+    `weights` [ncrops, 2] weights each (student view, teacher view) pair, see DINOLoss.pair_weights.
+    With sharded=True, the outputs are the slices of the out_dim outputs held by this process for
+    the batches of all the processes (see DINOHead), and the logsumexps and dot products are reduced
+    across the processes.
+    """
+    @staticmethod
+    def forward(ctx, student_output, teacher_out, weights, student_temp, chunk_size, sharded=False):
+        out_dim = student_output.shape[-1]
+        # [ncrops * B] outputs of each process
+        groups = utils.get_world_size() if sharded else 1
+        s = student_output.view(groups, len(weights), -1, out_dim)
+        q = teacher_out.view(groups, 2, -1, out_dim)
+        lse, dots = [], 0
+        for start in range(0, out_dim, chunk_size):
+            x = s[..., start:start + chunk_size].float() / student_temp
+            qc = q[..., start:start + chunk_size]
+            lse.append(torch.logsumexp(x, dim=-1))
+            dots = dots + weights[:, :1] * torch.einsum("gvbd,gbd->gvb", x, qc[:, 0]) \
+                + weights[:, 1:] * torch.einsum("gvbd,gbd->gvb", x, qc[:, 1])
+        lse = torch.stack(lse, dim=-1)
+        # total weight of the target of each student output (the teacher outputs sum to 1)
+        mass = torch.einsum("vw,gwb->gvb", weights, q.sum(dim=-1))
+        if sharded:
+            lse = utils.distributed_logsumexp(lse)
+            partial_sums = torch.stack([mass, dots])
+            dist.all_reduce(partial_sums)
+            mass, dots = partial_sums.unbind()
+        else:
+            lse = torch.logsumexp(lse, dim=-1)
+        ctx.save_for_backward(student_output, teacher_out, weights, lse, mass)
+        ctx.student_temp, ctx.chunk_size, ctx.groups = student_temp, chunk_size, groups
+        return (lse * mass - dots).sum() / (groups * s.shape[2] * weights.sum())
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        student_output, teacher_out, weights, lse, mass = ctx.saved_tensors
+        out_dim = student_output.shape[-1]
+        s = student_output.view(ctx.groups, len(weights), -1, out_dim)
+        q = teacher_out.view(ctx.groups, 2, -1, out_dim)
+        scale = grad_output / (ctx.groups * s.shape[2] * weights.sum() * ctx.student_temp)
+        grad = torch.empty_like(s)
+        for start in range(0, out_dim, ctx.chunk_size):
+            end = start + ctx.chunk_size
+            x = s[..., start:end].float() / ctx.student_temp
+            target = torch.einsum("vw,gwbd->gvbd", weights, q[..., start:end])
+            probs = torch.exp(x - lse[..., None])
+            grad[..., start:end] = (mass[..., None] * probs - target) * scale
+        return grad.view_as(student_output), None, None, None, None, None
+
+
 class DataAugmentationDINO(object):
-    def __init__(self, global_crops_scale, local_crops_scale, local_crops_number):
-        flip_and_color_jitter = transforms.Compose([
-            transforms.RandomHorizontalFlip(p=0.5),
+    global_crops_size = 96
+    local_crops_size = 48
+
+    def __init__(self, global_crops_scale, local_crops_scale, local_crops_number, seed=0):
+        flip_and_color_jitter = utils.Compose([
+            utils.RandomHorizontalFlip(p=0.5),
             #transforms.RandomApply(
             #    [transforms.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.2, hue=0.1)],
             #    p=0.8
             #),
             #transforms.RandomGrayscale(p=0.2),
         ])
-        normalize = transforms.Compose([
+        normalize = utils.Compose([
             #transforms.ToTensor(),
             #transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
         ])
 
         # first global crop
-        self.global_transfo1 = transforms.Compose([
-            transforms.RandomResizedCrop(96, scale=global_crops_scale, interpolation=Image.BICUBIC),
+        self.global_transfo1 = utils.Compose([
+            utils.RandomResizedCrop(self.global_crops_size, scale=global_crops_scale, interpolation=Image.BICUBIC),
             flip_and_color_jitter,
             utils.GaussianBlur(1.0),
             normalize,
         ])
         # second global crop
-        self.global_transfo2 = transforms.Compose([
-            transforms.RandomResizedCrop(96, scale=global_crops_scale, interpolation=Image.BICUBIC),
+        self.global_transfo2 = utils.Compose([
+            utils.RandomResizedCrop(self.global_crops_size, scale=global_crops_scale, interpolation=Image.BICUBIC),
             flip_and_color_jitter,
             utils.GaussianBlur(0.1),
             #utils.Solarization(0.2),
@@ -449,19 +832,32 @@ class DataAugmentationDINO(object):
         ])
         # transformation for the local small crops
         self.local_crops_number = local_crops_number
-        self.local_transfo = transforms.Compose([
-            transforms.RandomResizedCrop(48, scale=local_crops_scale, interpolation=Image.BICUBIC),
+        self.local_transfo = utils.Compose([
+            utils.RandomResizedCrop(self.local_crops_size, scale=local_crops_scale, interpolation=Image.BICUBIC),
             flip_and_color_jitter,
             utils.GaussianBlur(p=0.5),
             normalize,
         ])
 
-    def __call__(self, image):
+        # the random decisions for the views of a sample are derived from
+        # (seed, epoch, sample index, view index) when the sample index is given
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __call__(self, image, index=None, repeat=0):
+        nviews = 2 + self.local_crops_number
+        rngs = [None] * nviews
+        if index is not None:
+            rngs = [utils.augmentation_rng(self.seed, self.epoch, index, repeat * nviews + v)
+                    for v in range(nviews)]
         crops = []
-        crops.append(self.global_transfo1(image))
-        crops.append(self.global_transfo2(image))
-        for _ in range(self.local_crops_number):
-            crops.append(self.local_transfo(image))
+        crops.append(self.global_transfo1(image, rngs[0]))
+        crops.append(self.global_transfo2(image, rngs[1]))
+        for v in range(self.local_crops_number):
+            crops.append(self.local_transfo(image, rngs[2 + v]))
         return crops
 
 
@@ -0,0 +1,61 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A script to run data-parallel training with several processes on the local machine,
+e.g. on a cpu-only node with --device cpu (gloo backend):
+    python run_local.py --nprocs 4 --device cpu --arch deit_tiny ...
+The cpus of the machine are split evenly between the processes.
+"""
+import argparse
+import os
+from pathlib import Path
+
+import torch
+
+import main_dino
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Local multi-process DINO", parents=[main_dino.get_args_parser()])
+    parser.add_argument("--nprocs", default=2, type=int, help="Number of processes to spawn")
+    parser.add_argument("--threads_per_proc", default=0, type=int, help="""Number of torch threads
+        of each process, 0 for splitting the cpus of the machine evenly between the processes""")
+    parser.add_argument("--master_port", default=29500, type=int, help="Port used by the process group")
+    return parser.parse_args()
+
+
+def run(local_rank, args):
+    # same environment as torch.distributed.launch
+    os.environ.update(
+        MASTER_ADDR="127.0.0.1",
+        MASTER_PORT=str(args.master_port),
+        RANK=str(local_rank),
+        LOCAL_RANK=str(local_rank),
+        WORLD_SIZE=str(args.nprocs),
+        LOCAL_WORLD_SIZE=str(args.nprocs),
+    )
+    torch.set_num_threads(args.threads_per_proc)
+    main_dino.train_dino(args)
+
+
+def main():
+    args = parse_args()
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    if not args.threads_per_proc:
+        args.threads_per_proc = max(len(os.sched_getaffinity(0)) // args.nprocs, 1)
+    torch.multiprocessing.spawn(run, args=(args,), nprocs=args.nprocs)
+
+
+if __name__ == "__main__":
+    main()
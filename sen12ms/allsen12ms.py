@@ -5,6 +5,7 @@ from .data import trainregions, valregions, holdout_regions, data_transform
 import h5py
 import numpy as np
 from .download import download_sen12ms, download_regions
+from .pyramid import TilePyramid, pyramid_key
 import geopandas as gpd
 
 CLASSES = ['Barren', 'Savanna', 'Urban Build-up', 'Croplands', 'Grassland',
@@ -12,11 +13,16 @@ CLASSES = ['Barren', 'Savanna', 'Urban Build-up', 'Croplands', 'Grassland',
 
 class AllSen12MSDataset(torch.utils.data.Dataset):
     def __init__(self, root, fold, transform, tansform_coord=None,
-                 classes=None, seasons=None, split_by_region=True, download=True):
+                 classes=None, seasons=None, split_by_region=True, download=True, pyramid_levels=None,
+                 transform_with_index=False):
         super(AllSen12MSDataset, self).__init__()
 
         self.transform = transform
         self.transform_coord = tansform_coord
+        # sizes of the precomputed s2 levels (see pyramid.py) passed to the transform with the tile
+        self.pyramid_levels = pyramid_levels
+        # call the transform as transform(image, index), e.g. to derive its randomness from the index
+        self.transform_with_index = transform_with_index
 
         self.h5file_path = os.path.join(root, "sen12ms.h5")
         index_file = os.path.join(root, "sen12ms.csv")
@@ -88,17 +94,39 @@ class AllSen12MSDataset(torch.utils.data.Dataset):
     def __getitem__(self, index):
         path = self.paths.iloc[index]
 
-        with h5py.File(self.h5file_path, 'r') as data:
-            s2 = data[path.h5path + "/s2"][()]
-            s1 = data[path.h5path + "/s1"][()]
-            label = data[path.h5path + "/lc"][()]
+        if self.pyramid_levels:
+            image, target = self.read_pyramid(path.h5path)
+        else:
+            with h5py.File(self.h5file_path, 'r') as data:
+                s2 = data[path.h5path + "/s2"][()]
+                s1 = data[path.h5path + "/s1"][()]
+                label = data[path.h5path + "/lc"][()]
 
-        image, target = data_transform(s1, s2, label)
+            image, target = data_transform(s1, s2, label)
+            image = torch.from_numpy(image)
 
-        image = self.transform(torch.from_numpy(image))
+        image = self.transform(image, index) if self.transform_with_index else self.transform(image)
         #reg =  self.regions[path.h5path.split('/')[1]][0]
         #if self.transform_coord is not None:
         #    reg = self.transform_coord(reg)
 
         t2,c = np.unique(target.flatten(), return_counts=True)
         return image, t2[np.argmax(c)]
+
+    def read_pyramid(self, h5path):
+        """reads the pyramid levels of a tile. the full resolution s2 tile is only read if a crop needs it"""
+        with h5py.File(self.h5file_path, 'r') as data:
+            levels = [data[pyramid_key(h5path, size)][()] for size in self.pyramid_levels]
+            label = data[h5path + "/lc"][()]
+            size = data[h5path + "/s2"].shape[-2:]
+
+        def read_full():
+            with h5py.File(self.h5file_path, 'r') as data:
+                s2 = data[h5path + "/s2"][()]
+            return torch.from_numpy(data_transform(None, s2, label)[0])
+
+        scaled_levels = []
+        for level in levels:
+            level, target = data_transform(None, level, label)
+            scaled_levels.append(torch.from_numpy(level))
+        return TilePyramid(read_full, scaled_levels, size), target
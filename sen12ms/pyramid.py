@@ -0,0 +1,65 @@
+import argparse
+import os
+
+import h5py
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+
+def pyramid_key(h5path, size):
+    """name of the dataset storing the `size` px version of the s2 tile at `h5path`"""
+    return f"{h5path}/s2_{size}"
+
+
+def build_pyramid(root, sizes=(128,), overwrite=False):
+    """
+    stores downsampled versions of every s2 tile of sen12ms.h5 next to the full resolution tile
+    (as <h5path>/s2_<size>) so that small crops can be taken from a coarser level.
+    downsampling averages pixels (area interpolation) and keeps the dtype of the original tile.
+    """
+    h5file_path = os.path.join(root, "sen12ms.h5")
+    paths = pd.read_csv(os.path.join(root, "sen12ms.csv"), index_col=0)
+
+    with h5py.File(h5file_path, 'r+') as data:
+        for h5path in tqdm(paths.h5path, desc="building pyramid"):
+            s2 = data[h5path + "/s2"][()]
+            for size in sizes:
+                key = pyramid_key(h5path, size)
+                if key in data:
+                    if not overwrite:
+                        continue
+                    del data[key]
+                level = F.interpolate(torch.from_numpy(s2.astype(np.float32))[None],
+                                      size=(size, size), mode="area")[0].numpy()
+                if np.issubdtype(s2.dtype, np.integer):
+                    level = np.round(level)
+                data.create_dataset(key, data=level.astype(s2.dtype))
+
+
+class TilePyramid(object):
+    """
+    a tile and precomputed downsampled versions of it (the levels, sorted from coarsest to finest).
+    the full resolution tile is given by a function and only read when a crop needs it.
+    """
+    def __init__(self, read_full, levels, size):
+        self.read_full = read_full
+        self.levels = sorted(levels, key=lambda level: level.shape[-1])
+        self.size = size
+        self._full = None
+
+    def full(self):
+        if self._full is None:
+            self._full = self.read_full()
+        return self._full
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Precompute downsampled sen12ms tiles')
+    parser.add_argument('--root', type=str, required=True, help='folder containing sen12ms.h5 and sen12ms.csv')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128], help='side lengths of the pyramid levels')
+    parser.add_argument('--overwrite', action='store_true', help='recompute existing levels')
+    args = parser.parse_args()
+    build_pyramid(args.root, args.sizes, args.overwrite)
@@ -0,0 +1,49 @@
+"""
+Run a function in several local cpu processes (gloo backend) and collect what each returns.
+"""
+import os
+import socket
+import tempfile
+
+import torch
+import torch.distributed as dist
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _run(rank, fn, args, world_size, port, out, init_process_group):
+    # same environment as torch.distributed.launch (see run_local.py)
+    os.environ.update(
+        MASTER_ADDR="127.0.0.1",
+        MASTER_PORT=str(port),
+        RANK=str(rank),
+        LOCAL_RANK=str(rank),
+        WORLD_SIZE=str(world_size),
+        LOCAL_WORLD_SIZE=str(world_size),
+    )
+    torch.set_num_threads(1)
+    if init_process_group:
+        dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        result = fn(*args)
+    finally:
+        if dist.is_initialized():
+            dist.destroy_process_group()
+    torch.save(result, out.format(rank))
+
+
+def run_processes(fn, world_size=2, args=(), init_process_group=True):
+    """
+    Returns the list (by rank) of the results of fn(*args) in `world_size` processes. The processes
+    are forked: `fn` can be defined in the test module, and sees the modules imported by the test.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, "{}.pt")
+        torch.multiprocessing.start_processes(
+            _run, args=(fn, args, world_size, free_port(), out, init_process_group),
+            nprocs=world_size, start_method="fork")
+        return [torch.load(out.format(rank), weights_only=False) for rank in range(world_size)]
@@ -0,0 +1,91 @@
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import utils
+import vision_transformer as vits
+from main_dino import DINOLoss, DINOHead, get_args_parser, train_one_epoch
+from distributed import run_processes
+
+
+def reference_loss(student_output, teacher_output, center, ncrops, teacher_temp, student_temp=0.1):
+    """the loss as it was first written: one cross-entropy per (student view, teacher view) pair"""
+    student_out = (student_output / student_temp).chunk(ncrops)
+    teacher_out = F.softmax((teacher_output - center) / teacher_temp, dim=-1).detach().chunk(2)
+    total_loss = 0
+    n_loss_terms = 0
+    for iq, q in enumerate(teacher_out):
+        for v in range(len(student_out)):
+            if v == iq:
+                continue
+            total_loss += torch.sum(-q * F.log_softmax(student_out[v], dim=-1), dim=-1).mean()
+            n_loss_terms += 1
+    return total_loss / n_loss_terms
+
+
+@pytest.mark.parametrize("chunk_size", [0, 100, 256])
+def test_loss_matches_reference(chunk_size):
+    ncrops, batch_size, out_dim = 6, 5, 256
+    torch.manual_seed(0)
+    student_output = torch.randn(ncrops * batch_size, out_dim) * 3
+    teacher_output = torch.randn(2 * batch_size, out_dim) * 3
+    loss_fn = DINOLoss(out_dim, ncrops, 0.04, 0.07, 3, 10, chunk_size=chunk_size)
+    loss_fn.center = torch.randn(1, out_dim)
+    center = loss_fn.center.clone()
+
+    student = student_output.clone().requires_grad_()
+    loss = loss_fn(student, teacher_output, epoch=1)
+    loss.backward()
+    reference_student = student_output.clone().requires_grad_()
+    reference = reference_loss(reference_student, teacher_output, center, ncrops, loss_fn.teacher_temp_schedule[1])
+    reference.backward()
+
+    torch.testing.assert_close(loss, reference, rtol=1e-6, atol=1e-6)
+    torch.testing.assert_close(student.grad, reference_student.grad, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("chunk_size", [0, 100])
+def test_center_update_matches_reference(chunk_size):
+    torch.manual_seed(0)
+    loss_fn = DINOLoss(64, 4, 0.04, 0.04, 0, 10, chunk_size=chunk_size)
+    center = torch.zeros(1, 64)
+    for _ in range(3):
+        teacher_output = torch.randn(6, 64)
+        loss_fn(torch.randn(12, 64), teacher_output, epoch=0)
+        center = center * 0.9 + teacher_output.mean(dim=0, keepdim=True) * (1 - 0.9)
+    loss_fn.sync_center()
+    torch.testing.assert_close(loss_fn.center, center)
+
+
+def _accumulated_step(images, accum_steps):
+    """loss, center and student gradients of one optimizer step over `images`, in accum_steps micro-batches"""
+    def network():
+        torch.manual_seed(0)
+        return utils.MultiCropWrapper(vits.deit_tiny(), DINOHead(192, 256))
+    student, teacher = nn.parallel.DistributedDataParallel(network()), network()
+    for p in teacher.parameters():
+        p.requires_grad = False
+    teacher_ema = utils.TeacherEMA(student.module.parameters(), teacher.parameters())
+    dino_loss = DINOLoss(256, len(images), 0.04, 0.04, 0, 1)
+    # no learning rate nor weight decay: the gradients of the step are left in the parameters
+    optimizer = torch.optim.AdamW(utils.get_params_groups(student), lr=0)
+    args = get_args_parser().parse_args([])
+    args.epochs, args.accum_steps, args.device, args.clip_grad, args.freeze_last_layer = 1, accum_steps, "cpu", 0, 0
+    micro_batches = [([x.chunk(accum_steps)[i] for x in images], None) for i in range(accum_steps)]
+    stats = train_one_epoch(student, teacher, teacher_ema, dino_loss, micro_batches, optimizer,
+                            [0.], [0.], [0.996], 0, None, utils.PrecisionPolicy("fp32", "cpu"), args)
+    dino_loss.sync_center()
+    return stats["loss"], dino_loss.center, [p.grad for p in student.parameters()]
+
+
+def test_gradient_accumulation_matches_large_batch():
+    torch.manual_seed(1)
+    images = [torch.randn(8, 3, 64, 64) for _ in range(2)] + [torch.randn(8, 3, 32, 32) for _ in range(2)]
+    (loss, center, grads), = run_processes(_accumulated_step, 1, (images, 1))
+    (accumulated_loss, accumulated_center, accumulated_grads), = run_processes(_accumulated_step, 1, (images, 2))
+    assert loss == pytest.approx(accumulated_loss, rel=1e-6)
+    torch.testing.assert_close(accumulated_center, center)
+    assert any(grad is not None for grad in grads)
+    for grad, accumulated_grad in zip(grads, accumulated_grads):
+        torch.testing.assert_close(accumulated_grad, grad, rtol=1e-4, atol=1e-6)
@@ -0,0 +1,171 @@
+"""
+Multi-process tests, run in local cpu processes with the gloo backend.
+"""
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.distributed.optim import ZeroRedundancyOptimizer
+
+import utils
+import vision_transformer as vits
+from main_dino import DINOLoss, DINOHead
+from distributed import run_processes
+
+
+def _overlapped_center(out_dim, batch_size, steps):
+    rank = dist.get_rank()
+    loss_fn = DINOLoss(out_dim, 4, 0.04, 0.04, 0, 10)
+    center = torch.zeros(1, out_dim)
+    generator = torch.Generator().manual_seed(rank)
+    losses, reference_losses = [], []
+    for _ in range(steps):
+        teacher_output = torch.randn(2 * batch_size, out_dim, generator=generator)
+        student_output = torch.randn(4 * batch_size, out_dim, generator=generator)
+        losses.append(loss_fn(student_output, teacher_output, 0))
+        # blocking update, as the center was first computed
+        reference_losses.append(loss_fn.cross_entropy(
+            student_output, F.softmax((teacher_output - center) / 0.04, dim=-1), loss_fn.pair_weights("cpu")))
+        batch_center = torch.sum(teacher_output, dim=0, keepdim=True)
+        dist.all_reduce(batch_center)
+        batch_center = batch_center / (len(teacher_output) * dist.get_world_size())
+        center = center * 0.9 + batch_center * (1 - 0.9)
+    loss_fn.sync_center()
+    return loss_fn.center, center, torch.stack(losses), torch.stack(reference_losses)
+
+
+def test_overlapped_center_update():
+    for center, reference, losses, reference_losses in run_processes(_overlapped_center, 2, (512, 8, 4)):
+        assert torch.equal(center, reference)
+        assert torch.equal(losses, reference_losses)
+
+
+def _dino_steps(shard_head, steps, ncrops=4, batch_size=3, out_dim=64):
+    """losses (averaged over the processes), gradient norms, student and center after `steps` SGD steps"""
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    torch.manual_seed(0)
+    student = utils.MultiCropWrapper(vits.deit_tiny(), DINOHead(192, out_dim, shard_out_dim=shard_head))
+    teacher = utils.MultiCropWrapper(vits.deit_tiny(), DINOHead(192, out_dim, shard_out_dim=shard_head))
+    sharded_params = [n for n, p in student.named_parameters() if getattr(p, "sharded", False)]
+    nn.parallel.DistributedDataParallel._set_params_and_buffers_to_ignore_for_model(student, sharded_params)
+    student = nn.parallel.DistributedDataParallel(student)
+    teacher.load_state_dict(student.module.state_dict())
+    for p in teacher.parameters():
+        p.requires_grad = False
+    teacher_ema = utils.TeacherEMA(student.module.parameters(), teacher.parameters())
+    dino_loss = DINOLoss(out_dim, ncrops, 0.04, 0.04, 0, 10, sharded=shard_head)
+    optimizer = torch.optim.SGD(utils.get_params_groups(student), lr=0.05, momentum=0.9)
+    utils.shard_optimizer_state(optimizer, [p for p in student.parameters() if getattr(p, "sharded", False)])
+
+    generator = torch.Generator().manual_seed(rank)
+    losses, norms = [], []
+    for _ in range(steps):
+        images = [torch.randn(batch_size, 3, 32, 32, generator=generator) for _ in range(2)]
+        images += [torch.randn(batch_size, 3, 16, 16, generator=generator) for _ in range(ncrops - 2)]
+        optimizer.zero_grad()
+        loss = dino_loss(student(images), teacher(images[:2]), 0)
+        loss.backward()
+        norms.append(utils.clip_gradients(list(student.parameters()), 0.3))
+        optimizer.step()
+        teacher_ema.update(0.9)
+        # a sharded loss is already the loss of the whole batch
+        loss = loss.detach().clone()
+        if not shard_head:
+            dist.all_reduce(loss)
+            loss /= world_size
+        losses.append(loss)
+    dino_loss.sync_center()
+    return torch.stack(losses), torch.stack(norms), student.module.state_dict(), dino_loss.state_dict()
+
+
+def test_sharded_head_matches_unsharded():
+    losses, norms, student, center = run_processes(_dino_steps, 2, (False, 3))[0]
+    for sharded_losses, sharded_norms, sharded_student, sharded_center in run_processes(_dino_steps, 2, (True, 3)):
+        torch.testing.assert_close(sharded_losses, losses, rtol=1e-5, atol=1e-6)
+        torch.testing.assert_close(sharded_norms, norms, rtol=1e-4, atol=1e-6)
+        # the state dicts hold the full (gathered) head and center
+        for k, v in student.items():
+            torch.testing.assert_close(sharded_student[k], v, rtol=1e-4, atol=1e-6)
+        torch.testing.assert_close(sharded_center["center"], center["center"], rtol=1e-5, atol=1e-6)
+
+
+def _zero_head_steps(steps):
+    """student head trained with --shard_optimizer: norms used by the last layer and actual ones"""
+    torch.manual_seed(0)
+    head = nn.parallel.DistributedDataParallel(DINOHead(32, 64, norm_last_layer=False))
+    optimizer = ZeroRedundancyOptimizer(head.parameters(), optimizer_class=torch.optim.SGD, lr=0.1)
+    generator = torch.Generator().manual_seed(dist.get_rank())
+    norms = []
+    for _ in range(steps):
+        optimizer.zero_grad()
+        head(torch.randn(8, 32, generator=generator)).square().sum().backward()
+        # the parameters a process does not own are broadcast into it by their owner
+        optimizer.step()
+        last_layer = head.module.last_layer
+        norms.append((last_layer.norms().clone(), last_layer.weight_v.detach().norm(dim=1)))
+    return norms
+
+
+def test_normalized_linear_with_sharded_optimizer():
+    for norms in run_processes(_zero_head_steps, 2, (3,)):
+        for used, actual in norms:
+            torch.testing.assert_close(used, actual)
+
+
+def _adamw(shard_optimizer, model):
+    params_groups = utils.get_params_groups(model)
+    if shard_optimizer:
+        return ZeroRedundancyOptimizer(params_groups, optimizer_class=torch.optim.AdamW)
+    return torch.optim.AdamW(params_groups)
+
+
+def _adamw_steps(model, optimizer, steps, seed):
+    generator = torch.Generator().manual_seed(seed + dist.get_rank())
+    for it in range(steps):
+        # changing schedules, the weight decay is only set on the regularized group (see train_one_epoch)
+        for i, param_group in enumerate(optimizer.param_groups):
+            param_group["lr"] = 1e-3 * (it + 1)
+            if i == 0:
+                param_group["weight_decay"] = 0.04 + 0.01 * it
+        optimizer.zero_grad()
+        model(torch.randn(8, 32, generator=generator)).square().mean().backward()
+        utils.clip_gradients(list(model.parameters()), 0.3)
+        optimizer.step()
+
+
+def _optimizer_steps(shard_optimizer, checkpoint):
+    """
+    Head trained with AdamW, sharded or not. Then its optimizer state is saved in `checkpoint`
+    and restored into a sharded and an unsharded optimizer, which take more steps: they should
+    match the optimizer that was not interrupted.
+    """
+    torch.manual_seed(0)
+    head = nn.parallel.DistributedDataParallel(DINOHead(32, 64))
+    optimizer = _adamw(shard_optimizer, head)
+    _adamw_steps(head, optimizer, 3, 0)
+    state_dict = utils.optimizer_state_dict(optimizer)
+    if utils.is_main_process():
+        torch.save({"optimizer": state_dict}, checkpoint)
+    dist.barrier()
+    results = {"trained": {k: v.clone() for k, v in head.module.state_dict().items()}}
+    for resume_sharded in (False, True):
+        resumed = nn.parallel.DistributedDataParallel(DINOHead(32, 64))
+        resumed.module.load_state_dict(results["trained"])
+        resumed_optimizer = _adamw(resume_sharded, resumed)
+        utils.restart_from_checkpoint(checkpoint, optimizer=resumed_optimizer)
+        _adamw_steps(resumed, resumed_optimizer, 2, 10)
+        results["resumed_sharded" if resume_sharded else "resumed"] = resumed.module.state_dict()
+    _adamw_steps(head, optimizer, 2, 10)
+    results["continued"] = head.module.state_dict()
+    return results
+
+
+def test_sharded_optimizer_matches_unsharded(tmp_path):
+    reference = run_processes(_optimizer_steps, 2, (False, tmp_path / "unsharded.pth"))[0]
+    for results in run_processes(_optimizer_steps, 2, (True, tmp_path / "sharded.pth")):
+        for k, v in reference["trained"].items():
+            torch.testing.assert_close(results["trained"][k], v)
+        for run in (reference, results):
+            for k, v in run["continued"].items():
+                torch.testing.assert_close(run["resumed"][k], v)
+                torch.testing.assert_close(run["resumed_sharded"][k], v)
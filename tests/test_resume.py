@@ -0,0 +1,108 @@
+"""
+Resuming from a mid-epoch checkpoint, in local cpu processes with the gloo backend.
+"""
+import shutil
+
+import torch
+
+import main_dino
+import utils
+from distributed import run_processes
+
+
+class SyntheticDataset(torch.utils.data.Dataset):
+    """
+    Random 13-band images in place of sen12ms, with its arguments. The indices of the loaded
+    samples are kept in `loaded`.
+    """
+    loaded = []
+
+    def __init__(self, root, fold, transform=None, transform_with_index=False, length=24, **kwargs):
+        self.transform = transform
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        self.loaded.append(index)
+        generator = torch.Generator().manual_seed(index)
+        return self.transform(torch.rand(13, 128, 128, generator=generator), index), 0
+
+
+class Interrupted(Exception):
+    pass
+
+
+def _train(output_dir, stop_iteration=None):
+    """
+    Run train_dino, interrupted after the checkpoint of `stop_iteration`. Returns the losses of
+    its iterations, the (iteration, epoch, epoch_samples) of its checkpoints and the indices of
+    the samples it loaded.
+    """
+    args = main_dino.get_args_parser().parse_args([
+        "--device", "cpu", "--arch", "deit_tiny", "--out_dim", "1024", "--batch_size_per_gpu", "4",
+        "--epochs", "2", "--warmup_epochs", "0", "--local_crops_number", "2", "--num_workers", "0",
+        "--saveckp_iter_freq", "2", "--check_loss_freq", "1", "--output_dir", str(output_dir),
+    ])
+    losses, checkpoints = [], []
+    forward, save = main_dino.DINOLoss.forward, utils.CheckpointWriter.save
+
+    def record_loss(self, *inputs, **kwargs):
+        loss = forward(self, *inputs, **kwargs)
+        losses.append(loss.item())
+        return loss
+
+    def save_and_stop(self, state, *save_args, **kwargs):
+        save(self, state, *save_args, **kwargs)
+        checkpoints.append((state["iteration"], state["epoch"], state["epoch_samples"]))
+        if state["iteration"] == stop_iteration:
+            self.close()
+            raise Interrupted
+
+    # the processes are forked, this does not patch the classes of the test process
+    main_dino.DINOLoss.forward = record_loss
+    utils.CheckpointWriter.save = save_and_stop
+    try:
+        main_dino.train_dino(args)
+    except Interrupted:
+        pass
+    return {"losses": losses, "checkpoints": checkpoints, "samples": SyntheticDataset.loaded}
+
+
+def test_resume_mid_epoch(tmp_path, monkeypatch):
+    monkeypatch.setattr(main_dino, "AllSen12MSDataset", SyntheticDataset)
+    (tmp_path / "full").mkdir()
+    (tmp_path / "resumed").mkdir()
+    # 3 steps per epoch, the checkpoint of step 4 is in the middle of the second epoch
+    full = run_processes(_train, 2, (tmp_path / "full",), init_process_group=False)
+    interrupted = run_processes(_train, 2, (tmp_path / "resumed", 4), init_process_group=False)
+    resumed = run_processes(_train, 2, (tmp_path / "resumed",), init_process_group=False)
+    for rank in range(2):
+        assert len(full[rank]["losses"]) == 6 and len(interrupted[rank]["losses"]) == 4
+        assert interrupted[rank]["losses"] + resumed[rank]["losses"] == full[rank]["losses"]
+
+
+def test_elastic_resume(tmp_path, monkeypatch):
+    monkeypatch.setattr(main_dino, "AllSen12MSDataset", SyntheticDataset)
+    (tmp_path / "interrupted").mkdir()
+    # 2 processes, 3 steps of 8 samples per epoch: stopped after 8 samples of the second (last) epoch
+    interrupted = run_processes(_train, 2, (tmp_path / "interrupted", 4), init_process_group=False)
+    assert interrupted[0]["checkpoints"] == [(2, 0, 16), (3, 1, 0), (4, 1, 8)]
+    seen = [i for rank in interrupted for i in rank["samples"][12:]]
+
+    # 1 process, 6 steps of 4 samples per epoch: the last epoch goes on after its first 2 steps
+    shutil.copytree(tmp_path / "interrupted", tmp_path / "1")
+    (resumed,) = run_processes(_train, 1, (tmp_path / "1",), init_process_group=False)
+    assert resumed["checkpoints"] == [(10, 1, 16), (12, 2, 0)]
+    assert len(resumed["losses"]) == 4
+    # the samples left in the epoch, each once
+    assert sorted(seen + resumed["samples"]) == list(range(24))
+
+    # 3 processes, 2 steps of 12 samples per epoch: the interrupted step (8 samples) is done again
+    shutil.copytree(tmp_path / "interrupted", tmp_path / "3")
+    resumed = run_processes(_train, 3, (tmp_path / "3",), init_process_group=False)
+    for rank in resumed:
+        assert rank["checkpoints"] == [(4, 2, 0)]
+        assert len(rank["losses"]) == 2
+    assert sorted(i for rank in resumed for i in rank["samples"]) == list(range(24))
@@ -18,11 +18,16 @@ Mostly copy-paste from torchvision references or other public repos like DETR:
 https://github.com/facebookresearch/detr/blob/master/util/misc.py
 """
 import os
+import re
+import copy
 import sys
 import time
 import math
 import random
+import shutil
 import datetime
+import functools
+import threading
 import subprocess
 from collections import defaultdict, deque
 
@@ -30,6 +35,7 @@ import numpy as np
 import torch
 from torch import nn
 import torch.distributed as dist
+from torch.distributed.optim import ZeroRedundancyOptimizer
 from PIL import ImageFilter, ImageOps
 import torchvision
 
@@ -43,6 +49,39 @@ def replace_input_layer(model, inchannels):
     model.patch_embed.proj = inconv
     return model
 
+def augmentation_rng(seed, epoch, index, view):
+    """
+    Counter-based random generator for the augmentation of one view of one sample.
+    Philox is keyed with (seed, epoch) and its counter starts at (index, view): the
+    drawn values only depend on these four numbers, not on the data loading worker
+    or on the order in which samples are loaded.
+    """
+    return np.random.Generator(np.random.Philox(key=[seed, epoch], counter=[0, 0, index, view]))
+
+
+class Compose(torchvision.transforms.Compose):
+    """
+    Compose that forwards an optional random generator (see `augmentation_rng`) to each
+    transform. All the transforms must then accept an `rng` argument.
+    """
+    def __call__(self, img, rng=None):
+        for t in self.transforms:
+            img = t(img) if rng is None else t(img, rng=rng)
+        return img
+
+
+class RandomHorizontalFlip(torchvision.transforms.RandomHorizontalFlip):
+    """
+    RandomHorizontalFlip drawing from `rng` if given, from the global torch RNG otherwise.
+    """
+    def forward(self, img, rng=None):
+        if rng is None:
+            return super(RandomHorizontalFlip, self).forward(img)
+        if rng.random() < self.p:
+            return torchvision.transforms.functional.hflip(img)
+        return img
+
+
 class GaussianBlur(object):
     """
     Apply Gaussian Blur to the PIL image.
@@ -53,12 +92,18 @@ class GaussianBlur(object):
         self.radius_max = radius_max
         self.gb = torchvision.transforms.GaussianBlur(kernel_size=5, sigma=(radius_min, radius_max))
 
-    def __call__(self, img):
-        do_it = random.random() <= self.prob
-        if not do_it:
-            return img
+    def __call__(self, img, rng=None):
+        if rng is None:
+            do_it = random.random() <= self.prob
+            if not do_it:
+                return img
 
-        return self.gb(img)
+            return self.gb(img)
+
+        if rng.random() > self.prob:
+            return img
+        sigma = rng.uniform(self.radius_min, self.radius_max)
+        return torchvision.transforms.functional.gaussian_blur(img, self.gb.kernel_size, [sigma, sigma])
 
 
 class Solarization(object):
@@ -68,22 +113,325 @@ class Solarization(object):
     def __init__(self, p):
         self.p = p
 
-    def __call__(self, img):
-        if random.random() < self.p:
+    def __call__(self, img, rng=None):
+        if (random.random() if rng is None else rng.random()) < self.p:
             return ImageOps.solarize(img)
         else:
             return img
 
 
+class RandomResizedCrop(torchvision.transforms.RandomResizedCrop):
+    """
+    RandomResizedCrop drawing from `rng` if given (see `augmentation_rng`), and that also
+    accepts an image pyramid (an object with `levels`, `size` and `full()`, e.g.
+    sen12ms.pyramid.TilePyramid). The crop box is sampled at full resolution and taken
+    from the coarsest level that still covers the output size, so that most crops neither
+    read nor interpolate the full resolution image.
+    """
+    @staticmethod
+    def get_params_from_rng(height, width, scale, ratio, rng):
+        """same sampling as `get_params` but drawing from a numpy generator"""
+        area = height * width
+        log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        for _ in range(10):
+            target_area = area * rng.uniform(scale[0], scale[1])
+            aspect_ratio = math.exp(rng.uniform(log_ratio[0], log_ratio[1]))
+            w = int(round(math.sqrt(target_area * aspect_ratio)))
+            h = int(round(math.sqrt(target_area / aspect_ratio)))
+            if 0 < w <= width and 0 < h <= height:
+                i = int(rng.integers(0, height - h + 1))
+                j = int(rng.integers(0, width - w + 1))
+                return i, j, h, w
+
+        # fallback to central crop
+        in_ratio = float(width) / float(height)
+        if in_ratio < min(ratio):
+            w = width
+            h = int(round(w / min(ratio)))
+        elif in_ratio > max(ratio):
+            h = height
+            w = int(round(h * max(ratio)))
+        else:
+            w = width
+            h = height
+        return (height - h) // 2, (width - w) // 2, h, w
+
+    def forward(self, img, rng=None):
+        pyramid = hasattr(img, "levels")
+        height, width = img.size if pyramid else img.shape[-2:]
+        if rng is None:
+            i, j, h, w = self.get_params(torch.empty(0, height, width), self.scale, self.ratio)
+        else:
+            i, j, h, w = self.get_params_from_rng(height, width, self.scale, self.ratio, rng)
+        if not pyramid:
+            return torchvision.transforms.functional.resized_crop(img, i, j, h, w, self.size, self.interpolation)
+        for level in img.levels:
+            f = level.shape[-1] / width
+            if h * f >= self.size[0] and w * f >= self.size[1]:
+                return torchvision.transforms.functional.resized_crop(
+                    level, int(i * f), int(j * f), int(round(h * f)), int(round(w * f)),
+                    self.size, self.interpolation)
+        return torchvision.transforms.functional.resized_crop(
+            img.full(), i, j, h, w, self.size, self.interpolation)
+
+
+class RepeatedAugmentation(object):
+    """
+    Apply the same random transform several times to one loaded image.
+    """
+    def __init__(self, transform, num_repeats):
+        self.transform = transform
+        self.num_repeats = num_repeats
+
+    def __call__(self, image, index=None):
+        if index is None:
+            return [self.transform(image) for _ in range(self.num_repeats)]
+        return [self.transform(image, index, repeat) for repeat in range(self.num_repeats)]
+
+
+def repeated_augmentation_collate(batch):
+    """
+    Collate samples produced with `RepeatedAugmentation`: the r-th view set of every
+    image lands in the r-th block of the batch, so that the repeats of one image are
+    spread over the batch instead of being adjacent.
+    """
+    num_repeats = len(batch[0][0])
+    return torch.utils.data.dataloader.default_collate(
+        [(views[r], target) for r in range(num_repeats) for views, target in batch])
+
+
+class RepeatedAugSampler(torch.utils.data.DistributedSampler):
+    """
+    Distributed sampler for repeated augmentation.
+    Only len(dataset) // num_repeats images are drawn per epoch (a different subset at
+    every epoch), each of them producing num_repeats views. The number of views seen
+    per epoch, hence the number of iterations per epoch, is unchanged.
+    """
+    def __init__(self, dataset, num_repeats, num_replicas=None, rank=None, shuffle=True, seed=0):
+        super(RepeatedAugSampler, self).__init__(dataset, num_replicas=num_replicas, rank=rank,
+                                                 shuffle=shuffle, seed=seed)
+        self.num_repeats = num_repeats
+        self.num_selected = len(dataset) // num_repeats
+        self.num_samples = int(math.ceil(self.num_selected / self.num_replicas))
+        self.total_size = self.num_samples * self.num_replicas
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+        else:
+            indices = list(range(len(self.dataset)))
+        indices = indices[:self.num_selected]
+        # add extra samples to make it evenly divisible
+        indices += indices[:(self.total_size - len(indices))]
+        # subsample
+        return iter(indices[self.rank:self.total_size:self.num_replicas])
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """
+    Wraps a distributed sampler so that an epoch can start after its first `skip` samples (of all
+    the processes), to resume a training in the middle of an epoch without loading the batches
+    already seen. The samples left are split between the current processes, whose number can
+    differ from the one of the interrupted training.
+    """
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.skip = 0
+
+    def set_epoch(self, epoch, skip=0):
+        self.sampler.set_epoch(epoch)
+        self.skip = skip
+
+    def __iter__(self):
+        if not self.skip:
+            return iter(self.sampler)
+        # the samples of all the processes, process r draws indices[r::num_replicas]
+        sampler = copy.copy(self.sampler)
+        sampler.num_replicas, sampler.rank, sampler.num_samples = 1, 0, self.sampler.total_size
+        indices = list(sampler)[self.skip:]
+        return iter(indices[self.sampler.rank::self.sampler.num_replicas][:len(self)])
+
+    def __len__(self):
+        return (self.sampler.total_size - self.skip) // self.sampler.num_replicas
+
+
+def multicrop_collate(batch, out=None):
+    """
+    Collate multi-crop samples into one tensor per resolution group instead of one tensor
+    per crop. Returns a list of [crops in group, batch size, C, H, W] tensors and the
+    targets. The crops are written (and cast) into the tensors of `out` when their shapes
+    match. Samples produced with `RepeatedAugmentation` are flattened as in
+    `repeated_augmentation_collate`.
+    """
+    if isinstance(batch[0][0][0], (list, tuple)):
+        batch = [(views[r], target) for r in range(len(batch[0][0])) for views, target in batch]
+    crops = [views for views, _ in batch]
+    targets = torch.utils.data.dataloader.default_collate([target for _, target in batch])
+    groups = []
+    start, ncrops = 0, len(crops[0])
+    while start < ncrops:
+        end = start + 1
+        while end < ncrops and crops[0][end].shape == crops[0][start].shape:
+            end += 1
+        shape = (end - start, len(crops)) + crops[0][start].shape
+        if out is not None and len(out) > len(groups) and out[len(groups)].shape == shape:
+            group = out[len(groups)]
+        else:
+            group = crops[0][start].new_empty(shape)
+        for c in range(start, end):
+            for i, views in enumerate(crops):
+                group[c - start, i].copy_(views[c])
+        groups.append(group)
+        start = end
+    return groups, targets
+
+
+class MultiCropPrefetcher(object):
+    """
+    Iterate over a data loader using `multicrop_collate` and stage the next batch on
+    `device` while the current step runs. Each resolution group is cast to `dtype` once
+    and written into a ring of `num_buffers` reusable buffers (pinned on the host when
+    `device` is a GPU). Without loader workers, the crops are collated directly into
+    these buffers. Batches are returned as lists of per-crop views of the buffers, which
+    are overwritten `num_buffers` - 1 iterations later.
+    """
+    def __init__(self, loader, device, dtype=None, num_buffers=2):
+        assert num_buffers >= 2, "the prefetcher needs at least two buffers"
+        self.loader = loader
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.cuda = self.device.type == "cuda"
+        self.stream = torch.cuda.Stream(self.device) if self.cuda else None
+        self.buffers = [{} for _ in range(num_buffers)]
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _allocate(self, slot, groups):
+        shapes = [group.shape for group in groups]
+        dtypes = [self.dtype or group.dtype for group in groups]
+        slot["device"] = [torch.empty(s, dtype=d, device=self.device) for s, d in zip(shapes, dtypes)]
+        if self.cuda:
+            slot["host"] = [torch.empty(s, dtype=d, pin_memory=True) for s, d in zip(shapes, dtypes)]
+            slot["event"] = None
+
+    def _stage(self, slot, batch, collated):
+        host = "host" if self.cuda else "device"
+        if self.cuda and slot.get("event") is not None:
+            # wait for the previous copy out of the pinned buffers before overwriting them
+            slot["event"].synchronize()
+        if collated:
+            groups, targets = batch
+        else:
+            groups, targets = multicrop_collate(batch, out=slot.get(host))
+        if [g.shape for g in groups] != [b.shape for b in slot.get(host, [])]:
+            self._allocate(slot, groups)
+        for buf, group in zip(slot[host], groups):
+            if buf is not group:
+                buf.copy_(group)
+        if self.cuda:
+            with torch.cuda.stream(self.stream):
+                # the device buffers may still be read by the steps enqueued so far
+                self.stream.wait_stream(torch.cuda.current_stream(self.device))
+                for buf, pinned in zip(slot["device"], slot["host"]):
+                    buf.copy_(pinned, non_blocking=True)
+                slot["event"] = self.stream.record_event()
+        return targets
+
+    def _ready(self, slot):
+        if self.cuda:
+            torch.cuda.current_stream(self.device).wait_event(slot["event"])
+        return [crop for buf in slot["device"] for crop in buf.unbind(0)]
+
+    def __iter__(self):
+        collated = self.loader.num_workers > 0
+        if collated:
+            batches = iter(self.loader)
+        else:
+            dataset = self.loader.dataset
+            batches = ([dataset[i] for i in indices] for indices in self.loader.batch_sampler)
+        staged = None
+        for it, batch in enumerate(batches):
+            slot = self.buffers[it % len(self.buffers)]
+            targets = self._stage(slot, batch, collated)
+            if staged is not None:
+                yield self._ready(staged[0]), staged[1]
+            staged = (slot, targets)
+        if staged is not None:
+            yield self._ready(staged[0]), staged[1]
+
+
+class WorkerInit(object):
+    """
+    `worker_init_fn` limiting the number of threads used by each data loading worker
+    (torch intra-op threads, and OpenMP/BLAS threads of the libraries initialized in the
+    worker), and optionally pinning worker i to the cpus `worker_cpus[i]`.
+    """
+    def __init__(self, num_threads=1, worker_cpus=None):
+        self.num_threads = num_threads
+        self.worker_cpus = worker_cpus
+
+    def __call__(self, worker_id):
+        for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+            os.environ[var] = str(self.num_threads)
+        torch.set_num_threads(self.num_threads)
+        if self.worker_cpus is not None:
+            os.sched_setaffinity(0, self.worker_cpus[worker_id])
+
+
+def get_cpu_sets(local_rank, local_world_size, num_workers, cpus_per_worker=1):
+    """
+    Split the cpus available to this node evenly between the local ranks, and the share
+    of `local_rank` between its data loading workers (`cpus_per_worker` each, shared
+    round-robin if there are not enough) and its main process (the remaining ones, at
+    least one). Returns the cpus of the main process and the list of cpus of each worker.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    per_rank = max(len(cpus) // local_world_size, 1)
+    cpus = cpus[(local_rank * per_rank) % len(cpus):][:per_rank]
+    num_worker_cpus = min(num_workers * cpus_per_worker, len(cpus) - 1)
+    main_cpus = cpus[:len(cpus) - num_worker_cpus]
+    shared = cpus[len(main_cpus):] or main_cpus
+    worker_cpus = [[shared[(w * cpus_per_worker + k) % len(shared)] for k in range(cpus_per_worker)]
+                   for w in range(num_workers)]
+    return main_cpus, worker_cpus
+
+
+class ThroughputCollate(object):
+    """
+    Wrap a collate function to print, every `report_freq` batches, the number of samples
+    per second produced by the data loading worker calling it.
+    """
+    def __init__(self, collate_fn, report_freq):
+        self.collate_fn = collate_fn or torch.utils.data.dataloader.default_collate
+        self.report_freq = report_freq
+        self.num_batches = 0
+        self.num_samples = 0
+        self.start = None
+
+    def __call__(self, batch):
+        now = time.time()
+        if self.start is None:
+            self.start = now
+        self.num_batches += 1
+        self.num_samples += len(batch)
+        if self.num_batches % self.report_freq == 0:
+            worker = torch.utils.data.get_worker_info()
+            name = "main process" if worker is None else f"worker {worker.id}"
+            print(f"Data loading {name}: {self.num_samples / max(now - self.start, 1e-6):.1f} samples/s")
+            self.start, self.num_samples = now, 0
+        return self.collate_fn(batch)
+
+
 def load_pretrained_weights(model, pretrained_weights, checkpoint_key, model_name, patch_size):
     if os.path.isfile(pretrained_weights):
-        state_dict = torch.load(pretrained_weights, map_location="cpu")
-        if checkpoint_key is not None and checkpoint_key in state_dict:
-            print(f"Take key {checkpoint_key} in provided checkpoint dict")
-            state_dict = state_dict[checkpoint_key]
-        state_dict = {k.replace("module.", ""): v for k, v in state_dict.items()}
-        state_dict = {k.replace("backbone.", ""): v for k, v in state_dict.items()}
-        state_dict = {k.replace("head.", ""): v for k, v in state_dict.items()}
+        state_dict = load_checkpoint_key(pretrained_weights, checkpoint_key)
         msg = model.load_state_dict(state_dict, strict=False)
         print('Pretrained weights found at {} and loaded with msg: {}'.format(pretrained_weights, msg))
     else:
@@ -105,24 +453,295 @@ def load_pretrained_weights(model, pretrained_weights, checkpoint_key, model_nam
             print("There is no reference weights available for this model => We use random weights.")
 
 
+class TeacherEMA(object):
+    """
+    Exponential moving average of the student parameters into the teacher ones, done
+    with multi-tensor (foreach) ops: two fused ops per update instead of two small ops
+    per parameter. With `every` > 1, the update is applied every `every` steps only,
+    with the product of the momentums of these steps. This is exact if the student does
+    not change in between, and a close approximation for small learning rates.
+    """
+    def __init__(self, student_params, teacher_params, every=1):
+        self.student_params = [p.detach() for p in student_params]
+        self.teacher_params = [p.detach() for p in teacher_params]
+        assert len(self.student_params) == len(self.teacher_params)
+        self.every = every
+        self.momentum = 1.
+        self.num_steps = 0
+
+    @torch.no_grad()
+    def update(self, m):
+        self.momentum *= m
+        self.num_steps += 1
+        if self.num_steps % self.every:
+            return
+        torch._foreach_mul_(self.teacher_params, self.momentum)
+        torch._foreach_add_(self.teacher_params, self.student_params, alpha=1 - self.momentum)
+        self.momentum = 1.
+
+    def state_dict(self):
+        return {"momentum": self.momentum, "num_steps": self.num_steps}
+
+    def load_state_dict(self, state_dict):
+        self.momentum = state_dict["momentum"]
+        self.num_steps = state_dict["num_steps"]
+
+
 def clip_gradients(model, clip):
-    norms = []
-    for name, p in model.named_parameters():
-        if p.grad is not None:
-            param_norm = p.grad.data.norm(2)
-            norms.append(param_norm.item())
-            clip_coef = clip / (param_norm + 1e-6)
-            if clip_coef < 1:
-                p.grad.data.mul_(clip_coef)
+    """
+    Clip the gradient of each parameter of `model` (a module or a list of parameters) to
+    a norm of at most `clip`. The norms are computed by one multi-tensor op and applied
+    without synchronizing with the device. Returns the norms as a tensor.
+    """
+    params = model.parameters() if isinstance(model, nn.Module) else model
+    params = [p for p in params if p.grad is not None]
+    grads = [p.grad for p in params]
+    if len(grads) == 0:
+        return torch.zeros(0)
+    norms = torch.stack(torch._foreach_norm(grads))
+    sharded = [i for i, p in enumerate(params) if getattr(p, "sharded", False)]
+    if sharded and is_dist_avail_and_initialized():
+        # parameters split across the processes (see DINOHead): norm of the full gradient
+        squares = norms[sharded] ** 2
+        dist.all_reduce(squares)
+        norms[sharded] = squares.sqrt()
+    clip_coefs = (clip / (norms + 1e-6)).clamp(max=1.)
+    torch._foreach_mul_(grads, list(clip_coefs.unbind()))
     return norms
 
 
+def get_last_layer_params(model):
+    return [p for n, p in model.named_parameters() if "last_layer" in n]
+
+
 def cancel_gradients_last_layer(epoch, model, freeze_last_layer):
+    """
+    `model` is a module or its list of last layer parameters (see `get_last_layer_params`).
+    """
     if epoch >= freeze_last_layer:
         return
-    for n, p in model.named_parameters():
-        if "last_layer" in n:
-            p.grad = None
+    params = get_last_layer_params(model) if isinstance(model, nn.Module) else model
+    for p in params:
+        p.grad = None
+
+
+def load_checkpoint(path, mmap=True):
+    """
+    Load a checkpoint on cpu, merging its parts if it was written by several processes
+    (CheckpointWriter with sharded=True).
+    With mmap=True the file is memory-mapped: a tensor is only read from disk when it is used
+    (e.g. copied into a model by load_state_dict), so taking one network out of a training
+    checkpoint does not read the other one nor the optimizer state.
+    """
+    checkpoint = _torch_load(path, mmap)
+    if not isinstance(checkpoint, dict) or "checkpoint_parts" not in checkpoint:
+        return checkpoint
+    merged = {}
+    for part in checkpoint["checkpoint_parts"]:
+        _merge(merged, _torch_load(os.path.join(os.path.dirname(path), part), mmap))
+    return merged
+
+
+def load_checkpoint_key(path, checkpoint_key=None, prefixes=("module.", "backbone.", "head.")):
+    """
+    Load the state dict under `checkpoint_key` in a checkpoint (the whole checkpoint if it does
+    not have this key), with `prefixes` removed from the parameter names.
+    """
+    state_dict = load_checkpoint(path)
+    if checkpoint_key is not None and checkpoint_key in state_dict:
+        print(f"Take key {checkpoint_key} in provided checkpoint dict")
+        state_dict = state_dict[checkpoint_key]
+    # a single pass over the names, the tensors are not read
+    pattern = re.compile("|".join(re.escape(prefix) for prefix in prefixes))
+    return {pattern.sub("", k): v for k, v in state_dict.items()}
+
+
+def _torch_load(path, mmap=False):
+    # checkpoints also hold the args of the run (and numpy scalars), not only tensors
+    if mmap:
+        try:
+            return torch.load(path, map_location="cpu", weights_only=False, mmap=True)
+        except RuntimeError:
+            pass  # files of the legacy (non zip) format cannot be memory-mapped
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+
+def _merge(merged, part):
+    for k, v in part.items():
+        if isinstance(v, dict) and isinstance(merged.get(k), dict):
+            _merge(merged[k], v)
+        else:
+            merged[k] = v
+
+
+class CheckpointWriter(object):
+    """
+    Saves checkpoints without stalling the training: `save` copies the state into (reused, pinned)
+    cpu buffers and returns, the serialization runs in a background thread. Files are written to a
+    temporary file renamed once complete, so that an interrupted save never corrupts a checkpoint,
+    and the copies of a checkpoint (e.g. checkpoint0010.pth) are hard links to it.
+    With sharded=True, every process writes a part of the checkpoint (the tensors are balanced by
+    size) and the main process then writes the file itself, which lists the parts (see load_checkpoint).
+    `stats` holds the latencies (s) and size (MB) of the last completed save of this process.
+    """
+    def __init__(self, output_dir, sharded=False, timeout=3600):
+        self.output_dir = output_dir
+        self.sharded = sharded and is_dist_avail_and_initialized()
+        self.timeout = timeout
+        self.buffers = {}
+        self.thread = None
+        self.error = None
+        self.stats = {}
+
+    def save(self, state, name="checkpoint.pth", copies=()):
+        """
+        Save `state` (dict) as `name` and `copies` in output_dir. Call it on all the processes.
+        """
+        start = time.time()
+        self.wait()
+        stats = {"checkpoint_wait_time": time.time() - start}
+        start = time.time()
+        if self.sharded:
+            plan, token = self.plan(state)
+            state = _subset(state, plan[get_rank()])
+        elif not is_main_process():
+            return
+        snapshot = self.snapshot(state)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()  # non-blocking copies from the gpu
+        stats["checkpoint_snapshot_time"] = time.time() - start
+        stats["checkpoint_size_mb"] = sum(size for _, size in _leaves(snapshot)) / 2 ** 20
+        if self.sharded:
+            target, args = self.write_part, (snapshot, name, copies, plan, token, stats)
+        else:
+            target, args = self.write, (snapshot, name, copies, stats)
+        self.thread = threading.Thread(target=self.run, args=(target, args))
+        self.thread.start()
+
+    def wait(self):
+        """
+        Wait for the save in progress, if any, and raise its error if it failed.
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Saving the checkpoint failed") from error
+
+    close = wait
+
+    def snapshot(self, obj, path=()):
+        if torch.is_tensor(obj):
+            buffer = self.buffers.get(path)
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                buffer = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+                self.buffers[path] = buffer
+            return buffer.copy_(obj.detach(), non_blocking=True)
+        if isinstance(obj, dict):
+            return {k: self.snapshot(v, path + (k,)) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)([self.snapshot(v, path + (i,)) for i, v in enumerate(obj)])
+        return obj
+
+    def plan(self, state):
+        """
+        Paths of the values of `state` that each process writes, decided by the main process (only
+        processes holding an entry write it, e.g. the optimizer of ZeroRedundancyOptimizer), and a
+        name for the parts of this save.
+        """
+        held = [None] * get_world_size()
+        dist.all_gather_object(held, [k for k, v in state.items() if v is not None])
+        plan = [None]
+        if is_main_process():
+            parts, sizes = [[] for _ in held], [0] * len(held)
+            for path, size in sorted(_leaves(state), key=lambda leaf: -leaf[1]):
+                rank = min([r for r in range(len(held)) if path[0] in held[r]] or [0], key=sizes.__getitem__)
+                parts[rank].append(path)
+                sizes[rank] += size
+            plan = [(parts, str(time.time_ns()))]
+        dist.broadcast_object_list(plan)
+        return plan[0]
+
+    def run(self, target, args):
+        try:
+            target(*args)
+        except Exception as e:
+            self.error = e
+
+    def write(self, snapshot, name, copies, stats):
+        start = time.time()
+        path = os.path.join(self.output_dir, name)
+        _atomic_save(snapshot, path)
+        for copy_name in copies:
+            _atomic_link(path, os.path.join(self.output_dir, copy_name))
+        stats["checkpoint_write_time"] = time.time() - start
+        self.stats = stats
+
+    def write_part(self, snapshot, name, copies, plan, token, stats):
+        start = time.time()
+        parts = [f"{name}.{token}.part{rank}" for rank in range(len(plan))]
+        _atomic_save(snapshot, os.path.join(self.output_dir, parts[get_rank()]))
+        if is_main_process():
+            # the checkpoint only refers to the parts once they are all written
+            for part in parts:
+                while not os.path.isfile(os.path.join(self.output_dir, part)):
+                    if time.time() - start > self.timeout:
+                        raise TimeoutError(f"{part} was not written after {self.timeout}s")
+                    time.sleep(0.1)
+            path = os.path.join(self.output_dir, name)
+            previous_parts = []
+            if os.path.isfile(path):
+                previous_parts = _torch_load(path, mmap=True).get("checkpoint_parts", [])
+            _atomic_save({"checkpoint_parts": parts}, path)
+            for copy_name in copies:
+                for part in parts:
+                    _atomic_link(os.path.join(self.output_dir, part),
+                                 os.path.join(self.output_dir, copy_name + part[len(name):]))
+                _atomic_save({"checkpoint_parts": [copy_name + part[len(name):] for part in parts]},
+                             os.path.join(self.output_dir, copy_name))
+            for part in set(previous_parts) - set(parts):
+                os.remove(os.path.join(self.output_dir, part))
+        stats["checkpoint_write_time"] = time.time() - start
+        self.stats = stats
+
+
+def _atomic_save(obj, path):
+    torch.save(obj, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def _atomic_link(src, dst):
+    if os.path.exists(dst + ".tmp"):
+        os.remove(dst + ".tmp")
+    try:
+        os.link(src, dst + ".tmp")
+    except OSError:  # no hard links on this file system
+        shutil.copyfile(src, dst + ".tmp")
+    os.replace(dst + ".tmp", dst)
+
+
+def _leaves(obj, path=()):
+    """
+    (path, size in bytes) of the values of nested dicts `obj`.
+    """
+    if isinstance(obj, dict) and len(obj) > 0:
+        for k, v in obj.items():
+            yield from _leaves(v, path + (k,))
+    else:
+        yield path, obj.numel() * obj.element_size() if torch.is_tensor(obj) else 0
+
+
+def _subset(state, paths):
+    subset = {}
+    for path in paths:
+        value, node = state, subset
+        for k in path:
+            value = value[k]
+        for k in path[:-1]:
+            node = node.setdefault(k, {})
+        node[path[-1]] = value
+    return subset
 
 
 def restart_from_checkpoint(ckp_path, run_variables=None, **kwargs):
@@ -134,7 +753,7 @@ def restart_from_checkpoint(ckp_path, run_variables=None, **kwargs):
     print("Found checkpoint at {}".format(ckp_path))
 
     # open checkpoint file
-    checkpoint = torch.load(ckp_path, map_location="cpu")
+    checkpoint = load_checkpoint(ckp_path)
 
     # key is what to look for in the checkpoint file
     # value is the object to load
@@ -189,6 +808,31 @@ def bool_flag(s):
         raise argparse.ArgumentTypeError("invalid value for a boolean flag")
 
 
+def get_rng_states():
+    """
+    States of the random generators of every process (a list indexed by rank).
+    """
+    state = {"torch": torch.get_rng_state(), "numpy": np.random.get_state(), "random": random.getstate()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state()
+    if not is_dist_avail_and_initialized():
+        return [state]
+    states = [None] * get_world_size()
+    dist.all_gather_object(states, state)
+    return states
+
+
+def set_rng_state(state):
+    """
+    Restore the random generators of this process from one of the states of `get_rng_states`.
+    """
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["random"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state["cuda"])
+
+
 def fix_random_seeds(seed=31):
     """
     Fix random seeds.
@@ -222,7 +866,7 @@ class SmoothedValue(object):
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=get_comm_device())
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -377,6 +1021,51 @@ class MetricLogger(object):
             header, total_time_str, total_time / len(iterable)))
 
 
+class DeferredMetrics(object):
+    """
+    Keep scalar tensors on their device and only read them back every `flush_freq` iterations,
+    in a single transfer, into `metric_logger`. The values named in `check` are checked for
+    finiteness when they are read; other non finite values (e.g. the gradient norm of a step
+    skipped by the fp16 scaler) are not logged.
+    """
+    def __init__(self, metric_logger, flush_freq=1, check=("loss",)):
+        self.metric_logger = metric_logger
+        self.flush_freq = flush_freq
+        self.check = check
+        self.iterations = []
+        self.values = defaultdict(list)
+
+    def update(self, it, **kwargs):
+        """
+        stores the values of iteration `it` and returns (iteration, name, value) of the first non
+        finite checked value when the stored values are read back and one is found, None otherwise.
+        """
+        self.iterations.append(it)
+        for k, v in kwargs.items():
+            self.values[k].append(v.detach().float().reshape(()))
+        if len(self.iterations) >= self.flush_freq:
+            return self.flush()
+        return None
+
+    def flush(self):
+        if not self.iterations:
+            return None
+        names = list(self.values)
+        values = torch.stack([torch.stack(self.values[k]) for k in names]).tolist()
+        iterations = self.iterations
+        self.iterations = []
+        self.values = defaultdict(list)
+
+        for i, it in enumerate(iterations):
+            for k, v in zip(names, values):
+                if k in self.check and not math.isfinite(v[i]):
+                    return it, k, v[i]
+            for k, v in zip(names, values):
+                if math.isfinite(v[i]):
+                    self.metric_logger.update(**{k: v[i]})
+        return None
+
+
 def get_sha():
     cwd = os.path.dirname(os.path.abspath(__file__))
 
@@ -421,6 +1110,134 @@ def is_main_process():
     return get_rank() == 0
 
 
+def optimizer_state_dict(optimizer):
+    """
+    State dict of the optimizer to save. When its state is partitioned across the processes
+    (ZeroRedundancyOptimizer), it is gathered on the main process and None is returned elsewhere.
+    """
+    if isinstance(optimizer, ZeroRedundancyOptimizer):
+        optimizer.consolidate_state_dict(to=0)
+        return optimizer.state_dict() if is_main_process() else None
+    return optimizer.state_dict()
+
+
+def shard_range(size):
+    """
+    [start, end) of the part of a dimension of `size` held by this process, when the dimension
+    is split evenly across the processes.
+    """
+    world_size, rank = get_world_size(), get_rank()
+    assert size % world_size == 0, f"{size} cannot be split evenly across {world_size} processes"
+    shard_size = size // world_size
+    return rank * shard_size, (rank + 1) * shard_size
+
+
+@torch.no_grad()
+def gather_shards(tensor, dim=0):
+    """
+    Concatenation along `dim` of `tensor` of all the processes.
+    """
+    if not is_dist_avail_and_initialized():
+        return tensor
+    shards = [torch.empty_like(tensor) for _ in range(get_world_size())]
+    dist.all_gather(shards, tensor.contiguous())
+    return torch.cat(shards, dim=dim)
+
+
+def shard_state_dict(module, names, dim=0):
+    """
+    Store the full version of the tensors `names` of `module` (parameters or buffers split along
+    `dim` across the processes) in its state dict: they are gathered when saving and sliced when
+    loading, so that checkpoints do not depend on the number of processes.
+    """
+    def gather(module, state_dict, prefix, local_metadata):
+        for name in names:
+            state_dict[prefix + name] = gather_shards(state_dict[prefix + name], dim)
+
+    def split(module, state_dict, prefix, *args):
+        for name in names:
+            if prefix + name in state_dict:
+                full = state_dict[prefix + name]
+                start, end = shard_range(full.shape[dim])
+                state_dict[prefix + name] = full.narrow(dim, start, end - start)
+
+    module._register_state_dict_hook(gather)
+    module._register_load_state_dict_pre_hook(split, with_module=True)
+
+
+def shard_optimizer_state(optimizer, params):
+    """
+    Same as `shard_state_dict` for the optimizer state (e.g. AdamW moments) of `params`, parameters
+    split along their first dimension across the processes.
+    """
+    sharded = {id(p): p for p in params}
+
+    def sharded_states(state_dict):
+        # the state dict refers to the parameters by their index in the param groups
+        indices = [i for group in state_dict["param_groups"] for i in group["params"]]
+        params = [p for group in optimizer.param_groups for p in group["params"]]
+        for i, p in zip(indices, params):
+            if id(p) in sharded and i in state_dict["state"]:
+                yield i, p
+
+    def gather(optimizer, state_dict):
+        for i, p in sharded_states(state_dict):
+            state_dict["state"][i] = {k: gather_shards(v) if torch.is_tensor(v) and v.shape == p.shape else v
+                                      for k, v in state_dict["state"][i].items()}
+        return state_dict
+
+    def split(optimizer, state_dict):
+        state_dict = {**state_dict, "state": dict(state_dict["state"])}
+        for i, p in sharded_states(state_dict):
+            full_shape = (len(p) * get_world_size(),) + p.shape[1:]
+            state_dict["state"][i] = {k: v[slice(*shard_range(len(v)))] if torch.is_tensor(v) and v.shape == full_shape else v
+                                      for k, v in state_dict["state"][i].items()}
+        return state_dict
+
+    optimizer.register_state_dict_post_hook(gather)
+    optimizer.register_load_state_dict_pre_hook(split)
+
+
+@torch.no_grad()
+def distributed_logsumexp(x):
+    """
+    logsumexp over the last dimension of `x`, whose slices are split across the processes.
+    """
+    lse = torch.logsumexp(x, dim=-1)
+    if not is_dist_avail_and_initialized():
+        return lse
+    max_lse = lse.clone()
+    dist.all_reduce(max_lse, op=dist.ReduceOp.MAX)
+    sum_exp = torch.exp(lse - max_lse)
+    dist.all_reduce(sum_exp)
+    return max_lse + torch.log(sum_exp)
+
+
+class AllGatherBatch(torch.autograd.Function):
+    """
+    [world_size * N, ...] concatenation of the [N, ...] inputs of all the processes. The gradient
+    of the input of a process sums the gradients of all the processes, times the world size: each
+    process only backpropagates through its own samples, which DDP then averages.
+    """
+    @staticmethod
+    def forward(ctx, x):
+        return gather_shards(x)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        if not is_dist_avail_and_initialized():
+            return grad_output
+        grad_output = grad_output.contiguous()
+        if dist.get_backend() == "nccl":
+            grad = torch.empty_like(grad_output[:len(grad_output) // get_world_size()])
+            dist.reduce_scatter_tensor(grad, grad_output)
+        else:  # gloo has no reduce-scatter
+            grad_output = grad_output.clone()
+            dist.all_reduce(grad_output)
+            grad = grad_output[slice(*shard_range(len(grad_output)))]
+        return grad * get_world_size()
+
+
 def save_on_master(*args, **kwargs):
     if is_main_process():
         torch.save(*args, **kwargs)
@@ -442,6 +1259,9 @@ def setup_for_distributed(is_master):
 
 
 def init_distributed_mode(args):
+    # gpus use nccl, cpu processes (--device cpu) use gloo
+    args.device = getattr(args, "device", "cuda")
+    use_cuda = args.device == "cuda"
     # launched with torch.distributed.launch
     if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
         args.rank = int(os.environ["RANK"])
@@ -450,32 +1270,213 @@ def init_distributed_mode(args):
     # launched with submitit on a slurm cluster
     elif 'SLURM_PROCID' in os.environ:
         args.rank = int(os.environ['SLURM_PROCID'])
-        args.gpu = args.rank % torch.cuda.device_count()
+        if use_cuda:
+            args.gpu = args.rank % torch.cuda.device_count()
+        else:
+            args.gpu = int(os.environ.get('SLURM_LOCALID', 0))
     # launched naively with `python main_dino.py`
     # we manually add MASTER_ADDR and MASTER_PORT to env variables
-    elif torch.cuda.is_available():
-        print('Will run the code on one GPU.')
+    elif torch.cuda.is_available() or not use_cuda:
+        print('Will run the code on one {}.'.format('GPU' if use_cuda else 'CPU process'))
         args.rank, args.gpu, args.world_size = 0, 0, 1
         os.environ['MASTER_ADDR'] = '127.0.0.1'
         os.environ['MASTER_PORT'] = '29500'
     else:
-        print('Does not support training without GPU.')
+        print('Does not support training without GPU, use --device cpu.')
         sys.exit(1)
 
     dist.init_process_group(
-        backend="nccl",
+        backend="nccl" if use_cuda else "gloo",
         init_method=args.dist_url,
         world_size=args.world_size,
         rank=args.rank,
     )
 
-    torch.cuda.set_device(args.gpu)
+    if use_cuda:
+        torch.cuda.set_device(args.gpu)
     print('| distributed init (rank {}): {}'.format(
         args.rank, args.dist_url), flush=True)
     dist.barrier()
     setup_for_distributed(args.rank == 0)
 
 
+def get_comm_device():
+    """device of the tensors exchanged between processes: cuda with nccl, cpu with gloo"""
+    if is_dist_avail_and_initialized() and dist.get_backend() == "nccl":
+        return torch.device("cuda")
+    return torch.device("cpu")
+
+
+def get_comm_hook(name, local_world_size=1, powersgd_rank=4, powersgd_start_iter=1000):
+    """
+    (state, hook) of the DDP communication hook `name` for reducing the gradients:
+    "allreduce": full precision all-reduce (the DDP default),
+    "fp16" / "bf16": all-reduce of the gradients cast to 16 bits,
+    "powersgd": low-rank approximation of the gradient matrices, with error feedback (vanilla
+    all-reduce during the first `powersgd_start_iter` iterations),
+    "hierarchical": all-reduce within each node of `local_world_size` processes, then between the nodes.
+    """
+    from torch.distributed.algorithms.ddp_comm_hooks import default_hooks, powerSGD_hook
+    if name == "allreduce":
+        return None, default_hooks.allreduce_hook
+    if name == "fp16":
+        return None, default_hooks.fp16_compress_hook
+    if name == "bf16":
+        return None, default_hooks.bf16_compress_hook
+    if name == "powersgd":
+        if powersgd_start_iter < 2:
+            # DDP rebuilds its buckets after the first iteration, PowerSGD starts afterwards
+            raise ValueError(f"--powersgd_start_iter must be at least 2, got {powersgd_start_iter}")
+        state = powerSGD_hook.PowerSGDState(process_group=None, matrix_approximation_rank=powersgd_rank,
+                                            start_powerSGD_iter=powersgd_start_iter)
+        return state, _in_order(powerSGD_hook.powerSGD_hook)
+    if name == "hierarchical":
+        return HierarchicalGroups(local_world_size), _in_order(hierarchical_allreduce_hook)
+    raise ValueError(f"Unknown communication hook {name}")
+
+
+def _in_order(hook):
+    # hooks launching collectives from the callbacks of their futures: with gloo, the callbacks run
+    # on the threads of the backend in no particular order, so each bucket is reduced before the
+    # next one starts for all the processes to launch the collectives in the same order (with nccl,
+    # the callbacks run when the communication is queued, in order)
+    if get_comm_device().type == "cuda":
+        return hook
+
+    @functools.wraps(hook)
+    def in_order_hook(state, bucket):
+        fut = hook(state, bucket)
+        fut.wait()
+        return fut
+    return in_order_hook
+
+
+class HierarchicalGroups(object):
+    """
+    Process groups of the processes of each node (`intra`) and of the processes with the same local
+    rank on all the nodes (`inter`). The ranks of a node are assumed to be consecutive.
+    """
+    def __init__(self, local_world_size):
+        world_size = get_world_size()
+        assert world_size % local_world_size == 0, "the nodes must have the same number of processes"
+        self.local_world_size = local_world_size
+        self.local_rank = get_rank() % local_world_size
+        self.world_size = world_size
+        self.intra, _ = dist.new_subgroups_by_enumeration(
+            [list(range(n, n + local_world_size)) for n in range(0, world_size, local_world_size)])
+        self.inter, _ = dist.new_subgroups_by_enumeration(
+            [list(range(r, world_size, local_world_size)) for r in range(local_world_size)])
+
+
+def hierarchical_allreduce_hook(groups, bucket):
+    """
+    DDP communication hook averaging the gradients in three steps: all-reduce within the node (fast
+    links), all-reduce of 1 / local_world_size of the bucket between the nodes by each local rank
+    (slow links, a fraction of the data per process), all-gather of these parts within the node.
+    """
+    tensor = bucket.buffer().div_(groups.world_size)
+    fut = dist.all_reduce(tensor, group=groups.intra, async_op=True).get_future()
+
+    def inter_node(fut):
+        tensor = fut.value()[0]
+        chunk_size = -(-tensor.numel() // groups.local_world_size)
+        padded = tensor.new_zeros(chunk_size * groups.local_world_size)
+        padded[:tensor.numel()] = tensor
+        chunks = list(padded.view(groups.local_world_size, chunk_size))
+        dist.all_reduce(chunks[groups.local_rank], group=groups.inter)
+        dist.all_gather(chunks, chunks[groups.local_rank].clone(), group=groups.intra)
+        return padded[:tensor.numel()]
+
+    return fut.then(inter_node)
+
+
+class CommTimer(object):
+    """
+    Wraps a DDP communication hook to measure the gradient communication time: the time from the
+    launch of the reduction of each bucket to its completion, summed over the buckets. It overlaps
+    with the backward pass of the next buckets. On gpus it is measured with cuda events, read
+    without waiting once they are reached: `pop` returns the time of the buckets completed since
+    its last call.
+    """
+    def __init__(self, hook):
+        self.hook = hook
+        self.__name__, self.__qualname__ = hook.__name__, hook.__qualname__  # checked and logged by DDP
+        self.cuda = get_comm_device().type == "cuda"
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def _now(self):
+        if not self.cuda:
+            return time.perf_counter()
+        event = torch.cuda.Event(enable_timing=True)
+        event.record()
+        return event
+
+    def __call__(self, state, bucket):
+        start = self._now()
+
+        def done(fut):
+            # for nccl, runs on the stream of the communication
+            end = self._now()
+            with self.lock:
+                self.pending.append((start, end))
+            return fut.value()
+
+        return self.hook(state, bucket).then(done)
+
+    def pop(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        elapsed, left = 0., []
+        for start, end in pending:
+            if not self.cuda:
+                elapsed += end - start
+            elif end.query():
+                elapsed += start.elapsed_time(end) / 1000
+            else:
+                left.append((start, end))
+        with self.lock:
+            self.pending = left + self.pending
+        return elapsed
+
+
+class PrecisionPolicy(object):
+    """
+    Precision of the training: 'fp32', 'fp16' (autocast to float16 and loss scaling) or 'bf16'
+    (autocast to bfloat16, which has the range of float32 and needs no loss scaling).
+    """
+    dtypes = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+    def __init__(self, precision, device="cuda"):
+        assert precision in self.dtypes, "unknown precision {}".format(precision)
+        self.precision = precision
+        self.device = torch.device(device).type
+        self.dtype = self.dtypes[precision]
+        self.mixed = precision != "fp32"
+
+    @property
+    def input_dtype(self):
+        """dtype the inputs are cast to, None for keeping them as they are"""
+        return self.dtype if self.mixed else None
+
+    def autocast(self):
+        return torch.autocast(self.device, dtype=self.dtype, enabled=self.mixed)
+
+    def cast_input(self, x):
+        return x.to(self.dtype) if self.mixed else x
+
+    def grad_scaler(self):
+        """loss scaler of the policy (None without loss scaling), saved in the checkpoints as 'fp16_scaler'"""
+        if self.precision != "fp16":
+            return None
+        if self.device == "cuda":
+            return torch.cuda.amp.GradScaler()
+        return torch.amp.GradScaler(self.device)
+
+    def __repr__(self):
+        return "PrecisionPolicy({}, {})".format(self.precision, self.device)
+
+
 def accuracy(output, target, topk=(1,)):
     """Computes the accuracy over the k top predictions for the specified values of k"""
     maxk = max(topk)
@@ -576,13 +1577,19 @@ class MultiCropWrapper(nn.Module):
     forward passes = number of different resolutions used. We then
     concatenate all the output features and run the head forward on these
     concatenated features.
+    With packed=True (ViT backbones), the crops of all the resolutions go through the backbone
+    in a single forward pass instead, see VisionTransformer.forward_packed.
     """
-    def __init__(self, backbone, head):
+    def __init__(self, backbone, head, packed=False):
         super(MultiCropWrapper, self).__init__()
         # disable layers dedicated to ImageNet labels classification
         backbone.fc, backbone.head = nn.Identity(), nn.Identity()
         self.backbone = backbone
         self.head = head
+        self.packed = packed
+        # compiled version of the backbone and head forwards and the input shapes they were warmed up for
+        self.compiled = {}
+        self.warming_up = False
 
     def forward(self, x):
         # convert to list
@@ -593,15 +1600,48 @@ class MultiCropWrapper(nn.Module):
             return_counts=True,
         )[1], 0)
         start_idx = 0
+        groups = []
         for end_idx in idx_crops:
-            _out = self.backbone(torch.cat(x[start_idx: end_idx]))
-            if start_idx == 0:
-                output = _out
-            else:
-                output = torch.cat((output, _out))
+            groups.append(torch.cat(x[start_idx: end_idx]))
             start_idx = end_idx
+        if self.packed:
+            output = self.call(self.backbone.forward_packed, groups)
+        else:
+            output = torch.cat([self.call(self.backbone, inp) for inp in groups])
         # Run the head forward on the concatenated features.
-        return self.head(output)
+        return self.call(self.head, output)
+
+    def call(self, fn, x):
+        """
+        Run the compiled version of `fn` if it was warmed up for the shapes of `x`, `fn` otherwise:
+        other shapes (e.g. a new resolution, for which interpolate_pos_encoding would be traced
+        again) run eagerly instead of being recompiled.
+        """
+        if fn not in self.compiled:
+            return fn(x)
+        compiled_fn, shapes = self.compiled[fn]
+        key = tuple((inp.shape, inp.dtype) for inp in (x if isinstance(x, list) else [x]))
+        if self.warming_up:
+            shapes.add(key)
+        return compiled_fn(x) if key in shapes else fn(x)
+
+    def compile_resolutions(self, x, backward=False, **compile_kwargs):
+        """
+        Compile the backbone and head forwards with torch.compile and warm them up (forward and,
+        with backward=True, backward graphs) for the crops `x`, i.e. one graph per resolution.
+        """
+        backbone = self.backbone.forward_packed if self.packed else self.backbone
+        # the collectives of a head sharded across the processes run eagerly
+        for fn in (backbone,) if getattr(self.head, "sharded", False) else (backbone, self.head):
+            self.compiled[fn] = (torch.compile(fn, dynamic=False, **compile_kwargs), set())
+        self.warming_up = True
+        try:
+            output = self(x)
+            if backward:
+                output.float().sum().backward()
+                self.zero_grad(set_to_none=True)
+        finally:
+            self.warming_up = False
 
 
 def get_params_groups(model):
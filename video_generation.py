@@ -248,16 +248,9 @@ class VideoGenerator:
         model.to(DEVICE)
 
         if os.path.isfile(self.args.pretrained_weights):
-            state_dict = torch.load(self.args.pretrained_weights, map_location="cpu")
-            if (
-                self.args.checkpoint_key is not None
-                and self.args.checkpoint_key in state_dict
-            ):
-                print(
-                    f"Take key {self.args.checkpoint_key} in provided checkpoint dict"
-                )
-                state_dict = state_dict[self.args.checkpoint_key]
-            state_dict = {k.replace("module.", ""): v for k, v in state_dict.items()}
+            state_dict = utils.load_checkpoint_key(
+                self.args.pretrained_weights, self.args.checkpoint_key, ["module."]
+            )
             msg = model.load_state_dict(state_dict, strict=False)
             print(
                 "Pretrained weights found at {} and loaded with msg: {}".format(
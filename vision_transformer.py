@@ -20,16 +20,22 @@ from functools import partial
 
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
-from utils import trunc_normal_
+from utils import trunc_normal_, shard_range, shard_state_dict, AllGatherBatch
 
 
-def drop_path(x, drop_prob: float = 0., training: bool = False):
+def drop_path(x, drop_prob: float = 0., training: bool = False, packing=None):
     if drop_prob == 0. or not training:
         return x
     keep_prob = 1 - drop_prob
-    shape = (x.shape[0],) + (1,) * (x.ndim - 1)  # work with diff dim tensors, not just 2D ConvNets
-    random_tensor = keep_prob + torch.rand(shape, dtype=x.dtype, device=x.device)
+    if packing is not None:
+        # packed sequences (see PackedSequences): one draw per sequence, spread over its tokens
+        random_tensor = keep_prob + torch.rand(packing.num_sequences, dtype=x.dtype, device=x.device)
+        random_tensor = random_tensor[packing.seq_id][..., None]
+    else:
+        shape = (x.shape[0],) + (1,) * (x.ndim - 1)  # work with diff dim tensors, not just 2D ConvNets
+        random_tensor = keep_prob + torch.rand(shape, dtype=x.dtype, device=x.device)
     random_tensor.floor_()  # binarize
     output = x.div(keep_prob) * random_tensor
     return output
@@ -37,13 +43,29 @@ def drop_path(x, drop_prob: float = 0., training: bool = False):
 
 class DropPath(nn.Module):
     """Drop paths (Stochastic Depth) per sample  (when applied in main path of residual blocks).
+    With skip=True, the residual branches of the blocks are only computed for the kept samples instead
+    of being multiplied by a binary mask, see `residual`.
     """
-    def __init__(self, drop_prob=None):
+    def __init__(self, drop_prob=None, skip=False):
         super(DropPath, self).__init__()
         self.drop_prob = drop_prob
+        self.skip = skip
 
-    def forward(self, x):
-        return drop_path(x, self.drop_prob, self.training)
+    def forward(self, x, packing=None):
+        return drop_path(x, self.drop_prob, self.training, packing)
+
+    def residual(self, x, branch):
+        """
+        x + drop_path(branch(x)), where the branch only runs on the kept samples. The number of kept
+        samples is the stochastic rounding of keep_prob * batch size, so that each sample is kept
+        with probability keep_prob as with the mask (and there are only two batch shapes per block).
+        """
+        if not self.training or not self.drop_prob:
+            return x + branch(x)
+        keep_prob = 1 - self.drop_prob
+        num_kept = int(len(x) * keep_prob + torch.rand(()).item())
+        kept = torch.randperm(len(x), device=x.device)[:num_kept]
+        return x.index_add(0, kept, branch(x[kept]).to(x.dtype), alpha=1 / keep_prob)
 
 
 class Mlp(nn.Module):
@@ -77,12 +99,14 @@ class Attention(nn.Module):
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def forward(self, x):
+    def forward(self, x, attn_mask=None):
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]
 
         attn = (q @ k.transpose(-2, -1)) * self.scale
+        if attn_mask is not None:
+            attn = attn.masked_fill(~attn_mask, float('-inf'))
         attn = attn.softmax(dim=-1)
         attn = self.attn_drop(attn)
 
@@ -94,25 +118,65 @@ class Attention(nn.Module):
 
 class Block(nn.Module):
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
-                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm):
+                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm, drop_path_mode="mask"):
         super().__init__()
         self.norm1 = norm_layer(dim)
         self.attn = Attention(
             dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
-        self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
+        self.drop_path = DropPath(drop_path, skip=drop_path_mode == "skip")
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
-    def forward(self, x, return_attention=False):
-        y, attn = self.attn(self.norm1(x))
+    def forward(self, x, return_attention=False, packing=None):
+        if self.drop_path.skip and packing is None and not return_attention:
+            # packed sequences share their rows, they are still masked
+            x = self.drop_path.residual(x, lambda x: self.attn(self.norm1(x))[0])
+            return self.drop_path.residual(x, lambda x: self.mlp(self.norm2(x)))
+        y, attn = self.attn(self.norm1(x), None if packing is None else packing.attn_mask)
         if return_attention:
             return attn
-        x = x + self.drop_path(y)
-        x = x + self.drop_path(self.mlp(self.norm2(x)))
+        x = x + self.drop_path(y, packing)
+        x = x + self.drop_path(self.mlp(self.norm2(x)), packing)
         return x
 
 
+class PackedSequences(object):
+    """
+    Layout of token sequences of different lengths packed into `rows` rows (longest sequences
+    first, each into the least filled row). The tokens of a sequence are contiguous in their row
+    and only attend to each other, the rows are padded to the length of the longest one.
+    """
+    def __init__(self, lengths, rows, device):
+        fill, offsets, placement = [0] * rows, [0] * len(lengths), [0] * len(lengths)
+        for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+            row = min(range(rows), key=fill.__getitem__)
+            placement[i], offsets[i] = row, fill[row]
+            fill[row] += lengths[i]
+        self.rows, self.capacity = rows, max(fill)
+        # the padding of every row counts as one more sequence
+        self.num_sequences = len(lengths) + rows
+        starts = [row * self.capacity + offset for row, offset in zip(placement, offsets)]
+
+        # position of every token (sequences in order) in the flattened [rows * capacity] packing
+        self.index = torch.cat([torch.arange(start, start + length) for start, length in zip(starts, lengths)])
+        # position of the first ([CLS]) token of every sequence
+        self.first = torch.tensor(starts)
+        # sequence of every position, padding belongs to one sequence per row
+        seq_id = len(lengths) + torch.arange(self.rows).repeat_interleave(self.capacity)
+        seq_id[self.index] = torch.arange(len(lengths)).repeat_interleave(torch.tensor(lengths))
+        self.seq_id = seq_id.view(self.rows, self.capacity)
+        self.attn_mask = (self.seq_id[:, :, None] == self.seq_id[:, None, :])[:, None]
+        for k in ("index", "first", "seq_id", "attn_mask"):
+            setattr(self, k, getattr(self, k).to(device))
+
+    def pack(self, x):
+        """[total tokens, C] -> [rows, capacity, C]"""
+        packed = x.new_zeros(self.rows * self.capacity, x.shape[-1])
+        packed[self.index] = x
+        return packed.view(self.rows, self.capacity, -1)
+
+
 class PatchEmbed(nn.Module):
     """ Image to Patch Embedding
     """
@@ -135,9 +199,13 @@ class VisionTransformer(nn.Module):
     """ Vision Transformer """
     def __init__(self, img_size=[224], patch_size=16, in_chans=3, num_classes=0, embed_dim=768, depth=12,
                  num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop_rate=0., attn_drop_rate=0.,
-                 drop_path_rate=0., norm_layer=nn.LayerNorm, **kwargs):
+                 drop_path_rate=0., norm_layer=nn.LayerNorm, checkpoint_blocks=(), drop_path_mode="mask", **kwargs):
         super().__init__()
         self.num_features = self.embed_dim = embed_dim
+        # indices of the blocks whose activations are recomputed in the backward pass instead of stored
+        self.checkpoint_blocks = set(checkpoint_blocks)
+        # PackedSequences of forward_packed, by batch shapes
+        self.packings = {}
 
         self.patch_embed = PatchEmbed(
             img_size=img_size[0], patch_size=patch_size, in_chans=in_chans, embed_dim=embed_dim)
@@ -151,7 +219,8 @@ class VisionTransformer(nn.Module):
         self.blocks = nn.ModuleList([
             Block(
                 dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
-                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer)
+                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer,
+                drop_path_mode=drop_path_mode)
             for i in range(depth)])
         self.norm = norm_layer(embed_dim)
 
@@ -208,11 +277,40 @@ class VisionTransformer(nn.Module):
 
     def forward(self, x):
         x = self.prepare_tokens(x)
-        for blk in self.blocks:
-            x = blk(x)
+        for i, blk in enumerate(self.blocks):
+            if i in self.checkpoint_blocks and torch.is_grad_enabled():
+                # the rng state is restored for the recomputation, so DropPath drops the same samples
+                x = checkpoint(blk, x, use_reentrant=False)
+            else:
+                x = blk(x)
         x = self.norm(x)
         return x[:, 0]
 
+    def forward_packed(self, x):
+        """
+        Single pass over crops of several resolutions: `x` is a list of batches, one per resolution.
+        Their token sequences are packed into rows of equal length with block-diagonal attention
+        masks, and the [CLS] outputs of all the crops are returned in order.
+        """
+        tokens = [self.prepare_tokens(inp) for inp in x]
+        shapes = tuple(t.shape[:2] for t in tokens)
+        if (shapes, tokens[0].device) not in self.packings:
+            lengths = [length for n, length in shapes for _ in range(n)]
+            # as many rows as there are sequences of the longest length, e.g. one global
+            # crop and 4 local crops per row with 2 global crops for 8 local crops
+            rows = sum(length == max(lengths) for length in lengths)
+            self.packings[shapes, tokens[0].device] = PackedSequences(lengths, rows, tokens[0].device)
+        packing = self.packings[shapes, tokens[0].device]
+
+        x = packing.pack(torch.cat([t.flatten(0, 1) for t in tokens]))
+        for i, blk in enumerate(self.blocks):
+            if i in self.checkpoint_blocks and torch.is_grad_enabled():
+                x = checkpoint(blk, x, packing=packing, use_reentrant=False)
+            else:
+                x = blk(x, packing=packing)
+        x = self.norm(x)
+        return x.flatten(0, 1)[packing.first]
+
     def get_last_selfattention(self, x):
         x = self.prepare_tokens(x)
         for i, blk in enumerate(self.blocks):
@@ -254,8 +352,87 @@ def vit_base(patch_size=16, **kwargs):
     return model
 
 
+class WeightNormLinear(torch.autograd.Function):
+    """
+    x @ (g * v / norms).T, with norms the norm of each row of v, computed as (x @ v.T) * (g / norms)
+    so that the normalized weight is never materialized. The gradient of v includes the gradient
+    through its norms.
+    """
+    @staticmethod
+    def forward(ctx, x, v, g, norms):
+        ctx.x_dtype = x.dtype
+        device_type = x.device.type
+        x_mm, v_mm = x, v
+        if torch.is_autocast_enabled(device_type):
+            dtype = torch.get_autocast_dtype(device_type)
+            x_mm, v_mm = x.to(dtype), v.to(dtype)
+        ctx.save_for_backward(x_mm, v_mm, v, g, norms)
+        with torch.autocast(device_type, enabled=False):
+            out = nn.functional.linear(x_mm, v_mm)
+            return out.mul_((g[:, 0] / norms).to(out.dtype))
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, v_mm, v, g, norms = ctx.saved_tensors
+        grad_output = grad_output.to(x.dtype)
+        scale = g[:, 0] / norms
+        grad_x = grad_v = grad_g = None
+        if ctx.needs_input_grad[0]:
+            grad_x = ((grad_output * scale.to(x.dtype)) @ v_mm).to(ctx.x_dtype)
+        if ctx.needs_input_grad[1] or ctx.needs_input_grad[2]:
+            # gradient of x @ v.T and gradient of the scale of each output
+            grad_mm = (grad_output.t() @ x).to(v.dtype)
+            grad_scale = torch.linalg.vecdot(grad_mm, v)
+            if ctx.needs_input_grad[2]:
+                grad_g = (grad_scale / norms)[:, None]
+            if ctx.needs_input_grad[1]:
+                # through the product and through the norms: scale * (grad_mm - grad_scale / norms^2 * v)
+                grad_v = grad_mm.addcmul_(v, (grad_scale / norms ** 2)[:, None], value=-1).mul_(scale[:, None])
+        return grad_x, grad_v, grad_g, None
+
+
+class NormalizedLinear(nn.Module):
+    """
+    Drop-in replacement of nn.utils.weight_norm(nn.Linear(in_features, out_features, bias=False))
+    (same parameters weight_g and weight_v, so it loads its checkpoints) that does not materialize
+    the normalized weight, see WeightNormLinear. When weight_v does not require grad (the teacher),
+    the norms of its rows are only computed again when it changes, e.g. not for the micro-batches
+    of a step. Trained weights are not cached: an optimizer can overwrite them through .data (the
+    broadcast of ZeroRedundancyOptimizer), which does not bump their version.
+    """
+    def __init__(self, in_features, out_features):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight_g = nn.Parameter(torch.ones(out_features, 1))
+        self.weight_v = nn.Parameter(torch.empty(out_features, in_features))
+        nn.init.kaiming_uniform_(self.weight_v, a=math.sqrt(5))  # as nn.Linear
+        # (storage and version of weight_v, norms of its rows)
+        self._norms = None
+
+    def norms(self):
+        v = self.weight_v.detach()
+        if self.weight_v.requires_grad or torch.compiler.is_compiling():
+            return v.norm(dim=1)
+        key = (v.data_ptr(), v._version)
+        if self._norms is None or self._norms[0] != key:
+            self._norms = (key, v.norm(dim=1))
+        return self._norms[1]
+
+    def forward(self, x):
+        return WeightNormLinear.apply(x, self.weight_v, self.weight_g, self.norms())
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}"
+
+
 class DINOHead(nn.Module):
-    def __init__(self, in_dim, out_dim, use_bn=False, norm_last_layer=True, nlayers=3, hidden_dim=2048, bottleneck_dim=256):
+    """
+    With shard_out_dim=True, each process only holds a slice of the out_dim outputs of the last
+    layer and computes it for the features of the whole batch (all the processes).
+    """
+    def __init__(self, in_dim, out_dim, use_bn=False, norm_last_layer=True, nlayers=3, hidden_dim=2048, bottleneck_dim=256,
+                 shard_out_dim=False):
         super().__init__()
         nlayers = max(nlayers, 1)
         if nlayers == 1:
@@ -273,10 +450,20 @@ class DINOHead(nn.Module):
             layers.append(nn.Linear(hidden_dim, bottleneck_dim))
             self.mlp = nn.Sequential(*layers)
         self.apply(self._init_weights)
-        self.last_layer = nn.utils.weight_norm(nn.Linear(bottleneck_dim, out_dim, bias=False))
-        self.last_layer.weight_g.data.fill_(1)
+        self.last_layer = NormalizedLinear(bottleneck_dim, out_dim)
+        self.sharded = shard_out_dim
+        if shard_out_dim:
+            # slice of the same initialization as the full layer
+            start, end = shard_range(out_dim)
+            for name in ("weight_g", "weight_v"):
+                setattr(self.last_layer, name, nn.Parameter(getattr(self.last_layer, name).data[start:end].clone()))
+            self.last_layer.out_features = end - start
         if norm_last_layer:
             self.last_layer.weight_g.requires_grad = False
+        if shard_out_dim:
+            for p in self.last_layer.parameters():
+                p.sharded = True  # not synchronized by DDP, see main_dino.py
+            shard_state_dict(self, ["last_layer.weight_g", "last_layer.weight_v"])
 
     def _init_weights(self, m):
         if isinstance(m, nn.Linear):
@@ -287,5 +474,7 @@ class DINOHead(nn.Module):
     def forward(self, x):
         x = self.mlp(x)
         x = nn.functional.normalize(x, dim=-1, p=2)
+        if self.sharded:
+            x = AllGatherBatch.apply(x)
         x = self.last_layer(x)
         return x
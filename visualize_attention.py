@@ -118,11 +118,7 @@ if __name__ == '__main__':
     model.eval()
     model.to(device)
     if os.path.isfile(args.pretrained_weights):
-        state_dict = torch.load(args.pretrained_weights, map_location="cpu")
-        if args.checkpoint_key is not None and args.checkpoint_key in state_dict:
-            print(f"Take key {args.checkpoint_key} in provided checkpoint dict")
-            state_dict = state_dict[args.checkpoint_key]
-        state_dict = {k.replace("module.", ""): v for k, v in state_dict.items()}
+        state_dict = utils.load_checkpoint_key(args.pretrained_weights, args.checkpoint_key, ["module."])
         msg = model.load_state_dict(state_dict, strict=False)
         print('Pretrained weights found at {} and loaded with msg: {}'.format(args.pretrained_weights, msg))
     else: